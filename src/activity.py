@@ -1,39 +1,211 @@
+import asyncio
+import json
+import os
+import time
 from datetime import timedelta, timezone, datetime, UTC
 
+import aiohttp
 import discord
 
-from utils import send_message
+from activitystats import ActivityStats
+from config import SYSLOG_MAX_DELAY, SYSLOG_SPOOL
+from scheduler import Priority, scheduler
+from utils import CHAR_LIMIT, replace_file, send_message
 
-POST_MAX_QUEUE = 5                      # Max number of posts to queue before sending
-POST_MAX_DELTA = timedelta(minutes=5)   # Max amount of time posts should remain in queue
+POST_MAX_DELTA = timedelta(seconds=SYSLOG_MAX_DELAY)    # Max amount of time posts should remain in queue
+POST_MAX_BACKOFF = 4                                    # Most the base delta is stretched by when we're being rate limited
+POST_BASE_DELTA = POST_MAX_DELTA / POST_MAX_BACKOFF     # How long partial batches wait when we aren't, so fully stretched is the max
+POST_SLOW_SEND = 2.0                                    # A post taking longer than this, in seconds, means Discord made us wait
+POST_CHECK_INTERVAL = 15                                # How often, in seconds, the background task checks the queue's age
+SPOOL_FSYNC_EVERY = 10                                  # Number of spooled entries between forced writes to disk
 
 EPOCH = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc) # Start of Unix time
 
 class Syslog:
-    def __init__(self):
+    def __init__(self, stats: ActivityStats):
+        self.stats = stats
         self.logs = []
+        self.size = 0   # Length of the queued logs once joined together
         self.oldest = None
+        self.channel = None
+        self.backoff = 1
+        # Only one flush may be in flight at a time, otherwise concurrent events could post the same queue twice
+        self.lock = asyncio.Lock()
+        # Set once a full post's worth is queued, to wake the background task rather than each caller posting it themselves
+        self.wakeup = asyncio.Event()
+        self.flush_task = None
+
+        # Every queued entry is also appended to a spool file, which is only cleared once the entries are posted
+        # Anything left in it was never posted before we last went down, so queue it up to go out again
+        for log in self._read_spool():
+            self._queue(log)
+        self.spool = open(SYSLOG_SPOOL, 'a', encoding='utf-8')
+        self.unsynced = 0
 
     def setup(self, syslog: discord.TextChannel):
         self.channel = syslog
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def add_log(self, message: str, channel_id: int | None = None):
+        self.stats.add_event(channel_id)
+        log = self._stamp(message)
+        self._spool_log(log)
+        self._queue(log)
+        # Each post is packed as close to Discord's character limit as we can get it
+        # Posting is left to the background task, so a burst of events fills whole posts rather than each racing to send its own
+        if self.size >= CHAR_LIMIT:
+            self.wakeup.set()
+
+    async def add_file(self, message: str, file: discord.File, channel_id: int | None = None):
+        """
+        Posts an entry along with an attached file, such as a transcript too long to post as text
+        """
+        self.stats.add_event(channel_id)
+        # Attachments can't be batched with the other entries, so send out what's queued first to keep the channel in order
+        await self.flush()
+        if self.channel is None:
+            return
+        await scheduler.send(self.channel, self._stamp(message), Priority.LOW, file=file)
+
+    async def flush(self, full_only: bool = False):
+        """
+        Posts the queued entries, as few posts as they'll fit in
+
+        :param full_only: Only send posts filled up to the character limit, leaving the rest to fill up further
+        """
+        async with self.lock:
+            while len(self.logs) > 0 and self.channel is not None and (not full_only or self.size >= CHAR_LIMIT):
+                if not await self._send_batch():
+                    return
+
+    async def _send_batch(self) -> bool:
+        # Take as many entries from the front of the queue as fit in one post
+        # They stay queued until they've been posted, entries added while we wait on Discord go in behind them
+        count = 1
+        size = len(self.logs[0])
+        while count < len(self.logs) and size + len(self.logs[count]) + 1 <= CHAR_LIMIT:
+            size += len(self.logs[count]) + 1
+            count += 1
+        start = time.monotonic()
+        try:
+            sent = await send_message('\n'.join(self.logs[:count]), self.channel, Priority.LOW)
+        except (discord.errors.DiscordServerError, aiohttp.ClientError, OSError, asyncio.TimeoutError) as err:
+            # The connection or Discord is having trouble, which should pass, so keep these queued and spooled for next time
+            print(f"Unable to post syslog entries, will retry: {err}")
+            return False
+        except discord.errors.HTTPException:
+            # Discord rejected the post outright, so retrying it won't help
+            # Drop it rather than trying to send the same message over and over
+            self._dequeue(count)
+            self._rewrite_spool()
+            raise
+        if sent is None:
+            # Discord is having server issues, hold onto these and try again next time
+            return False
+        self._dequeue(count)
+        self._rewrite_spool()
+        self._update_backoff(time.monotonic() - start)
+        return True
+
+    def _update_backoff(self, elapsed: float):
+        # discord.py sleeps through rate limits for us, so a slow send means we're posting too often
+        # In that case, let partial batches wait longer so they fill up more before being sent
+        if elapsed > POST_SLOW_SEND:
+            self.backoff = min(self.backoff * 2, POST_MAX_BACKOFF)
+        else:
+            self.backoff = max(self.backoff // 2, 1)
+
+    async def close(self):
+        """
+        Stops the background task and posts anything still queued, so nothing is lost on shutdown
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        self._sync_spool()
+        self.spool.close()
+
+    async def _flush_loop(self):
+        # Post anything left over from the spool straight away
+        if len(self.logs) > 0:
+            await self._try_flush()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), POST_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                self._sync_spool()
+            except OSError as err:
+                print(f"Unable to sync syslog spool: {err}")
+            # Posts the queue once its oldest entry has waited too long, even if no other events come in
+            # Otherwise, only send what fills whole posts
+            # The deadline is brought forward by a check's worth, so the next check can't take it past the max
+            if self.oldest is not None and datetime.now(UTC) - self.oldest >= POST_BASE_DELTA * self.backoff - timedelta(seconds=POST_CHECK_INTERVAL):
+                await self._try_flush()
+            elif self.size >= CHAR_LIMIT:
+                await self._try_flush(full_only=True)
 
-    async def add_log(self, message: str):
+    async def _try_flush(self, full_only: bool = False):
+        try:
+            await self.flush(full_only)
+        except Exception as err:
+            # Anything escaping here would end the background task for good, and nothing would be posted on time again
+            print(f"Unable to post syslog entries: {err!r}")
+
+    def _stamp(self, message: str) -> str:
         now = datetime.now(UTC)
         unix = int((now - EPOCH).total_seconds())
-        log = f"<t:{unix}:f> {message}"
+        return f"<t:{unix}:f> {message}"
+
+    def _queue(self, log: str):
         self.logs.append(log)
+        self.size += len(log) if len(self.logs) == 1 else len(log) + 1
         if self.oldest is None:
-            self.oldest = now
-        if len(self.logs) >= POST_MAX_QUEUE or now - self.oldest > POST_MAX_DELTA:
-            # Note that this means we only have the potential to post logs when a loggable event fires
-            # Given the activity on the server, this seems likely to occur within the max delta time, but other solutions might be needed
-            # This also probably can have a race condition, so watch out for that
-            await self._post_logs()
-
-    async def _post_logs(self):
-        joined = '\n'.join(self.logs)
-        # We'll clear the logs first, to prevent issues where the same message is
-        # for some reason unable to be sent over and over
-        self.logs.clear()
-        self.oldest = None
-        await send_message(joined, self.channel)
+            self.oldest = datetime.now(UTC)
+
+    def _dequeue(self, count: int):
+        # Removes the first count entries, once they've been posted or given up on
+        sent = self.logs[:count]
+        del self.logs[:count]
+        self.size = max(self.size - sum(len(x) + 1 for x in sent), 0)
+        if len(self.logs) == 0:
+            self.oldest = None
+
+    def _spool_log(self, log: str):
+        # Entries can contain newlines, so store each one as a JSON string on its own line
+        self.spool.write(json.dumps(log) + '\n')
+        self.spool.flush()
+        # Flushing hands the entry to the OS, which is enough to survive the bot crashing
+        # Forcing it to disk is much slower, so only do that every so often
+        self.unsynced += 1
+        if self.unsynced >= SPOOL_FSYNC_EVERY:
+            self._sync_spool()
+
+    def _sync_spool(self):
+        if self.unsynced > 0:
+            os.fsync(self.spool.fileno())
+            self.unsynced = 0
+
+    def _rewrite_spool(self):
+        # Replace the spool with only the entries that are still waiting to be posted
+        self.spool.close()
+        replace_file(SYSLOG_SPOOL, "".join([json.dumps(log) + '\n' for log in self.logs]))
+        self.spool = open(SYSLOG_SPOOL, 'a', encoding='utf-8')
+        self.unsynced = 0
+
+    def _read_spool(self) -> list[str]:
+        if not os.path.exists(SYSLOG_SPOOL):
+            return []
+        logs = []
+        with open(SYSLOG_SPOOL, 'r', encoding='utf-8') as spool:
+            for line in spool:
+                try:
+                    logs.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The last line can be cut short if we went down mid-write
+                    pass
+        return logs
@@ -0,0 +1,108 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import db
+from logtypes import LogTypes
+
+FLUSH_INTERVAL = 60     # How often, in seconds, counts are written out to the DB
+HOURS_PER_WEEK = 7 * 24
+DEFAULT_RANGE = 7       # Number of days of syslog events to average over when no range is given
+NO_CHANNEL = 0          # Stands in for events that don't happen in a channel, such as joins and bans
+
+class ActivityStats:
+    """
+    Running counts of when moderation actions happen and how busy each channel is in the syslog.
+
+    Counts are bumped in memory as events come in, and periodically added onto the totals in the DB.
+    Reports only ever read those totals, so there's no need to go back through the logs to build them.
+    """
+    def __init__(self, counting_since: str):
+        self._counting_since = datetime.fromisoformat(counting_since)   # Actions before this were never counted
+        self._actions = Counter()   # (hour of week, log type) -> count
+        self._events = Counter()    # (channel ID, YYYY-MM-DD) -> count
+        self._flush_task = None
+
+    def setup(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    def add_action(self, log_type: LogTypes, timestamp: datetime, count: int = 1):
+        """
+        Counts a moderation action, by the hour of the week it happened in.
+
+        :param log_type: The kind of action.
+        :param timestamp: When it happened.
+        :param count: How much to change the count by.
+        """
+        timestamp = timestamp.astimezone(timezone.utc)
+        self._actions[(timestamp.weekday() * 24 + timestamp.hour, int(log_type))] += count
+
+    def remove_action(self, log_type: LogTypes, timestamp: datetime):
+        """
+        Uncounts a moderation action logged in error, if it was counted in the first place.
+
+        :param log_type: The kind of action.
+        :param timestamp: When it was logged.
+        """
+        if timestamp >= self._counting_since:
+            self.add_action(log_type, timestamp, -1)
+
+    def move_action(self, log_type: LogTypes, old: datetime, new: datetime):
+        """
+        Moves a moderation action whose log was edited to its new time.
+
+        :param log_type: The kind of action.
+        :param old: When it was logged before the edit.
+        :param new: When it's logged as now.
+        """
+        self.remove_action(log_type, old)
+        self.add_action(log_type, new)
+
+    def add_event(self, channel_id: int | None):
+        """
+        Counts a syslog event, by the channel and day it happened in.
+
+        :param channel_id: The channel the event happened in, or None if it wasn't in one.
+        """
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        self._events[(channel_id or NO_CHANNEL, day)] += 1
+
+    def flush(self):
+        # Swap the pending counts out first, anything counted while writing goes into the next flush
+        actions, self._actions = self._actions, Counter()
+        events, self._events = self._events, Counter()
+        if len(actions) > 0:
+            db.add_action_counts([(slot, log_type, count) for (slot, log_type), count in actions.items()])
+        if len(events) > 0:
+            db.add_event_counts([(channel, day, count) for (channel, day), count in events.items()])
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self.flush()
+
+    def get_heatmap(self) -> list[list[int]]:
+        """
+        :return: The number of each type of action for every hour of the week, starting Monday 00:00 UTC. Indexed by log type, then hour.
+        """
+        self.flush()
+        heatmap = [[0] * HOURS_PER_WEEK for _ in LogTypes]
+        for slot, log_type, count in db.get_action_counts():
+            heatmap[log_type][slot] = count
+        return heatmap
+
+    def get_event_rates(self, days: int = DEFAULT_RANGE) -> dict[int, float]:
+        """
+        :param days: The number of days, including today, to average over.
+        :return: The average number of syslog events per day for each channel ID.
+        """
+        self.flush()
+        start = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        return {channel: total / days for channel, total in db.get_event_counts(start)}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush()
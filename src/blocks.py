@@ -3,9 +3,10 @@ import discord
 import db
 
 class BlockedUsers:
-    def __init__(self):
-        block_db = db.get_blocklist()
-        self.blocklist = [x[0] for x in block_db]
+    def __init__(self, block_db: list[tuple]):
+        # Checked against every DM we receive, so keep it as a set
+        # The IDs are stored as text in the DB, so convert them back to match the user IDs we check against
+        self.blocklist = {int(x[0]) for x in block_db}
 
     def handle_block(self, user: discord.User, block: bool) -> str:
         is_blocked = self.is_in_blocklist(user.id)
@@ -24,7 +25,7 @@ class BlockedUsers:
 
     def _block_user(self, userid: int):
         db.add_block(userid)
-        self.blocklist.append(userid)
+        self.blocklist.add(userid)
 
     def _unblock_user(self, userid: int):
         db.remove_block(userid)
@@ -0,0 +1,146 @@
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_caches: list["AsyncCache"] = []
+
+class AsyncCache:
+    """
+    A size and age limited cache in front of a loader function, such as a DB query.
+
+    The loader can be a regular function or a coroutine function. If several callers miss on the same key at once, they share a single call to the loader.
+
+    Entries are evicted least recently used first once there are more than maxsize, and expire ttl seconds after being loaded.
+    Negative results (None, or anything else falsy such as an empty list) are kept for negative_ttl seconds instead, or not cached at all if that's 0.
+    """
+    def __init__(self, name: str, loader: Callable[[Any], Any], maxsize: int = 128, ttl: float | None = None, negative_ttl: float | None = None):
+        """
+        Creates a new cache.
+
+        :param name: The name to show for this cache in the stats.
+        :param loader: The function to call to get the value for a key if not present in the cache.
+        :param maxsize: The maximum number of items to hold before evicting entries.
+        :param ttl: How long, in seconds, an entry is kept. None to keep it until evicted.
+        :param negative_ttl: How long, in seconds, a negative result is kept. 0 to never cache them, or None to treat them like any other result.
+        """
+        self.name = name
+        self._loader = loader
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._entries: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+        self._loading: dict[Hashable, asyncio.Task] = {}
+        # Bumped whenever a key is invalidated, so a load that started before then doesn't store its outdated result
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        _caches.append(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: Hashable) -> Any:
+        """
+        Retrieve the value for the given key, loading it if it's not in the cache.
+
+        :param key: The key.
+        :return: The cached or newly loaded value.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires is None or expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            self.expirations += 1
+        self.misses += 1
+
+        # Someone else is already loading this, wait for theirs instead
+        # The load runs as its own task, so the caller that started it being cancelled doesn't leave everyone else waiting forever
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key))
+            self._loading[key] = task
+            task.add_done_callback(lambda x: self._finish_load(key, x))
+            # Mark any exception as retrieved, in case everyone waiting on it was cancelled
+            task.add_done_callback(lambda x: x.cancelled() or x.exception())
+        # Shielded so that one caller being cancelled doesn't cancel the load for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    def _finish_load(self, key: Hashable, task: asyncio.Task):
+        # The key may have been invalidated and a newer load started since, which needs to stay
+        if self._loading.get(key) is task:
+            del self._loading[key]
+
+    async def _load(self, key: Hashable) -> Any:
+        generation = self._generation
+        value = self._loader(key)
+        if inspect.isawaitable(value):
+            value = await value
+        if generation == self._generation:
+            self.set(key, value)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Set the value for a key, bypassing the loader.
+
+        :param key: The key.
+        :param value: The value.
+        """
+        ttl = self._ttl
+        if not value and self._negative_ttl is not None:
+            ttl = self._negative_ttl
+            if ttl == 0:
+                self._entries.pop(key, None)
+                return
+
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """
+        Removes a key from the cache, so the next lookup goes to the loader.
+
+        :param key: The key.
+        """
+        self._generation += 1
+        self._entries.pop(key, None)
+        # A load that's already underway may have read the old value, so later lookups need to start their own
+        self._loading.pop(key, None)
+
+    def clear(self):
+        """
+        Removes everything from the cache.
+        """
+        self._generation += 1
+        self._entries.clear()
+        self._loading.clear()
+
+    def get_stats(self) -> str:
+        """
+        :return: A one line summary of how this cache is doing.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups > 0 else 0
+        return f"`{self.name}`: {len(self)}/{self._maxsize} entries, {hit_rate:.1f}% hit rate ({self.hits} hits, {self.misses} misses), {self.evictions} evicted, {self.expirations} expired"
+
+def get_all_stats() -> str:
+    """
+    :return: The stats for every cache that has been created.
+    """
+    if len(_caches) == 0:
+        return "There are no caches"
+    return "\n".join([x.get_stats() for x in _caches])
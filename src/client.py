@@ -1,39 +1,132 @@
+import hashlib
+import json
+import resource
+import time
 from typing import cast
 
 import discord
 from discord.ext import commands
 
 from activity import Syslog
+from activitystats import ActivityStats
 from blocks import BlockedUsers
-from config import LOG_CHAN, MAILBOX, SPAM_CHAN, SYS_LOG, WATCHLIST_CHAN
+from cache import AsyncCache
+from config import HOME_SERVER, LOG_CHAN, MAILBOX, MEMBER_CACHE, MEMBER_CHUNKING, MESSAGE_STORE_SIZE, SPAM_CHAN, SYS_LOG, WATCHLIST_CHAN
 import db
+from messagestore import MessageStore
+from metrics import metrics
+from outbox import Outbox
+from responsetimes import ResponseTimes
 from spam import Spammers
 from waiting import AnsweringMachine
 from watcher import Watcher
 
+def get_peak_rss() -> float:
+    # Most memory we've used so far, in MiB. Linux reports it in KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Members looked up from Discord, when they aren't all kept in memory
+MEMBER_LOOKUP_SIZE = 1024
+MEMBER_LOOKUP_TTL = 60 * 60
+MEMBER_LOOKUP_NEGATIVE_TTL = 5 * 60   # Not being in the server changes more often, so don't trust it for as long
+
 class DiscordClient(commands.Bot):
     def __init__(self):
         intents = discord.Intents.all()
+        # Keeping every member of a large server in memory is slow to load and takes up a lot of room, and we only need a few of them
+        member_cache_flags = discord.MemberCacheFlags.all() if MEMBER_CACHE == "all" else discord.MemberCacheFlags.none()
         # The command prefix is never used, but we have to have something
-        super().__init__(command_prefix="$", intents=intents)
-        db.initialize()
+        super().__init__(command_prefix="$", intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=MEMBER_CHUNKING == "startup")
+        self._member_lookups = AsyncCache("home members", self._fetch_home_member, maxsize=MEMBER_LOOKUP_SIZE, ttl=MEMBER_LOOKUP_TTL, negative_ttl=MEMBER_LOOKUP_NEGATIVE_TTL)
+        state = db.initialize()
 
-        self.am = AnsweringMachine()
-        self.blocks = BlockedUsers()
-        self.spammers = Spammers()
-        self.syslog = Syslog()
-        self.watch = Watcher()
+        self.activity_stats = ActivityStats(state.action_counts_since)
+        self.am = AnsweringMachine(state.waiting)
+        self.blocks = BlockedUsers(state.blocklist)
+        self.messages = MessageStore(MESSAGE_STORE_SIZE)
+        self.outbox = Outbox(state.outbox)
+        self.response_times = ResponseTimes(state.conversations)
+        self.spammers = Spammers(self.outbox)
+        self.syslog = Syslog(self.activity_stats)
+        self.watch = Watcher(state.watchlist)
+        # Held until the message forwarder, which is created after us, has taken its share
+        self.startup_state: db.StartupState | None = state
 
     async def set_channels(self):
         self.mailbox = cast(discord.TextChannel, self.get_channel(MAILBOX))
         self.log = cast(discord.TextChannel, self.get_channel(LOG_CHAN))
         self.spam = cast(discord.TextChannel, self.get_channel(SPAM_CHAN))
         self.watchlist = cast(discord.TextChannel, self.get_channel(WATCHLIST_CHAN))
+        # This runs on every on_ready, which can fire again after a reconnect, so each setup only starts its background task once
         self.syslog.setup(self.get_channel(SYS_LOG))
+        self.am.setup()
+        self.activity_stats.setup()
+        self.outbox.setup(self)
+        metrics.setup()
+
+    async def get_home_member(self, user_id: int) -> discord.Member | None:
+        """
+        Looks up a user in the home server, using the member cache if it has them, otherwise asking Discord.
+
+        :param user_id: The user to look up.
+        :return: Their member object, or None if they're not in the server.
+        """
+        guild = self.get_guild(HOME_SERVER)
+        if guild is None:
+            return None
+        member = guild.get_member(user_id)
+        # Once every member has been loaded, not being in the cache means not being in the server
+        if member is not None or (MEMBER_CACHE == "all" and guild.chunked):
+            return member
+        return await self._member_lookups.get(user_id)
+
+    def forget_home_member(self, user_id: int):
+        """
+        Drops anything remembered about a user from Discord lookups, for when they join or leave.
+
+        :param user_id: The user.
+        """
+        self._member_lookups.invalidate(user_id)
 
-    async def sync_guild(self, guild: discord.Guild):
+    async def chunk_home_server(self):
+        """
+        Loads every member of the home server into the cache, for when that's been left until after we're ready.
+        """
+        guild = self.get_guild(HOME_SERVER)
+        if guild is None or guild.chunked:
+            return
+        start = time.monotonic()
+        await guild.chunk()
+        print(f"Loaded {guild.member_count} members in {time.monotonic() - start:.2f}s, peak memory is now {get_peak_rss():.0f} MiB")
+
+    async def _fetch_home_member(self, user_id: int) -> discord.Member | None:
+        guild = self.get_guild(HOME_SERVER)
+        if guild is None:
+            return None
+        try:
+            return await guild.fetch_member(user_id)
+        except discord.errors.NotFound:
+            return None
+
+    async def close(self):
+        # Post any queued syslog entries before we disconnect
+        await self.syslog.close()
+        await self.activity_stats.close()
+        await super().close()
+
+    async def sync_guild(self, guild: discord.Guild, force: bool = False) -> bool:
         import context
         self.tree.copy_global_to(guild=guild)
+
+        # on_guild_available fires after every reconnect, but the commands only change when we're updated
+        # Syncing is heavily rate limited, so skip it if Discord already has exactly what we'd send
+        commands = sorted([x.to_dict(self.tree) for x in self.tree.get_commands(guild=guild)], key=lambda x: (x["type"], x["name"]))
+        digest = hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()
+        if not force and db.get_command_hash(guild.id) == digest:
+            return False
+
         await self.tree.sync(guild=guild)
+        db.set_command_hash(guild.id, digest)
+        return True
 
 client = DiscordClient()
@@ -28,9 +28,34 @@ VALID_ROLES = cfg['roles']['admin']
 DM_BAN = cfg['DM']['ban']
 DM_WARN = cfg['DM']['warn']
 
-USER_PLOT = "./private/user_plot.png"
-MONTH_PLOT = "./private/month_plot.png"
+# Optional tuning values, older config files won't have these
+_syslog_cfg = cfg.get('syslog', {})
+SYSLOG_MAX_DELAY = _syslog_cfg.get('max_delay', 300)   # Longest time, in seconds, an entry may wait before being posted
+
+SYSLOG_SPOOL = "./private/syslog_spool.jsonl"
+
+_message_store_cfg = cfg.get('messageStore', {})
+MESSAGE_STORE_SIZE = _message_store_cfg.get('size', 50000)  # Number of recent messages to remember for logging edits and deletions
+
+# str: which members to keep in memory, "all" or "none"
+#      with "none", members are fetched from Discord when needed, and remembered for a while
+#      Discord only tells us what changed about a member, so nickname, role, and timeout changes can't be logged without "all"
+# str: when to download the full member list, "startup" before we're ready, "background" after, or "off" for never
+#      only used when caching all members, there's nowhere to put them otherwise
+_members_cfg = cfg.get('members', {})
+MEMBER_CACHE = _members_cfg.get('cache', "all")
+MEMBER_CHUNKING = _members_cfg.get('chunk', "startup") if MEMBER_CACHE == "all" else "off"
+
+# str: where to write handler and command metrics in Prometheus text format, or null to not write them
+# int: how often, in seconds, to rewrite the file
+_metrics_cfg = cfg.get('metrics', {})
+METRICS_PATH = _metrics_cfg.get('path', "./private/metrics.prom")
+METRICS_INTERVAL = _metrics_cfg.get('interval', 60)
 
 # list of int: the ids of roles to invite to new forwarded threads
 #              each role must have less than 100 members for the addition to work
 THREAD_ROLES = cfg['messageForwarding']['rolesToAddToThreads']
+
+# float: how long, in seconds, to wait for more DMs from a user before forwarding them all as one post
+#        0 forwards each DM on its own
+DM_BURST_WINDOW = cfg['messageForwarding'].get('burstWindow', 3)
@@ -1,12 +1,19 @@
+import re
+import time
+
 import discord
 
+from activitystats import NO_CHANNEL
+from cache import get_all_stats
 from client import client
 import logs
 from logtypes import LogTypes
+from metrics import instrumented, metrics
 from report import ReportModal
 import reply
 from say import SayModal
-from visualize import post_plots
+from scheduler import scheduler
+from visualize import post_activity, post_plots
 from utils import interaction_response_helper
 
 HELP_MESSAGE = (
@@ -16,9 +23,12 @@ HELP_MESSAGE = (
     "`/log` - Log a user infraction\n"
     "`/note` - Add a user note\n"
     "`/scam` - Log a scam\n"
+    "`/bulk-log` - Log the same infraction for several users at once\n"
     "`/search` - Search for a user's logs\n"
     "`/edit` - Edit an incorrect log\n"
     "`/remove` - Remove a log\n"
+    "`/log-timings` - Show how long each step of logging a user takes\n"
+    "`/response-times` - Show how long users wait for a reply to their DMs\n"
     "## Messaging Users\n"
     "`/dm` - Send a DM to a user\n"
     "`/reply` - Reply to the owner of a DM thread\n"
@@ -28,28 +38,96 @@ HELP_MESSAGE = (
     "`/waiting` - List users who are waiting for a reply\n"
     "`/clear` - Clear list of users waiting for reply\n"
     "## Misc.\n"
+    "`/activity` - Post when moderation actions happen and how busy each channel is\n"
+    "`/caches` - Show lookup cache hit rates\n"
     "`/graph` - Post graphs of moderator activity\n"
+    "`/queues` - Show how many outgoing posts are waiting to send\n"
     "`/say` - Post a message as the bot\n"
+    "`/stats` - Show how often each event handler and command runs, and how long it takes\n"
+    "`/sync` - Re-register slash commands with Discord, even if they haven't changed\n"
     "`/unmute` - Remove a user's timeout\n"
     "`/block` - Change if a user can DM the bot\n"
     "`/watch` - Change if a user is on the watchlist\n"
     "`/watchlist` - Print out the watchlist\n"
 )
 
+BULK_PROGRESS_INTERVAL = 2 # Min seconds between progress updates for bulk commands
+
 ### Slash Commands
+@client.tree.command(name="activity", description="Post when moderation actions happen and how busy each channel is")
+@discord.app_commands.describe(days="Number of days to average channel activity over")
+@instrumented("command")
+async def activity_slash(interaction: discord.Interaction, days: discord.app_commands.Range[int, 1, 365] = 7):
+    heatmap = client.activity_stats.get_heatmap()
+    rates = []
+    for channel_id, rate in client.activity_stats.get_event_rates(days).items():
+        channel = client.get_channel(channel_id)
+        if channel_id == NO_CHANNEL:
+            name = "No channel"
+        elif channel is None:
+            name = str(channel_id)
+        else:
+            name = f"#{channel.name}"
+        rates.append((name, rate))
+    await post_activity(interaction, heatmap, rates)
+
 @client.tree.command(name="block", description="Change if user can DM us")
 @discord.app_commands.describe(user="User", block="Block?")
+@instrumented("command")
 async def block_slash(interaction: discord.Interaction, user: discord.User, block: bool):
     response = client.blocks.handle_block(user, block)
     await interaction_response_helper(interaction, response)
 
+@client.tree.command(name="bulk-log", description="Log the same infraction for several users at once")
+@discord.app_commands.describe(users="User IDs or mentions, separated by spaces", reason="Reason for log", log_type="Type of log")
+@discord.app_commands.choices(log_type=[
+    discord.app_commands.Choice(name="Ban", value=LogTypes.BAN),
+    discord.app_commands.Choice(name="Warn", value=LogTypes.WARN),
+    discord.app_commands.Choice(name="Kick", value=LogTypes.KICK),
+    discord.app_commands.Choice(name="Scam", value=LogTypes.SCAM),
+])
+@instrumented("command")
+async def bulk_log_slash(interaction: discord.Interaction, users: str, reason: str, log_type: LogTypes):
+    if interaction.channel_id is None:
+        return
+    user_ids = list(dict.fromkeys([int(x) for x in re.findall(r"\d{15,20}", users)]))
+    if len(user_ids) == 0:
+        await interaction.response.send_message("I couldn't find any user IDs in that", ephemeral=True)
+        return
+    if len(user_ids) > logs.BULK_MAX_USERS:
+        await interaction.response.send_message(f"I can only log up to {logs.BULK_MAX_USERS} users at once", ephemeral=True)
+        return
+    await interaction.response.defer()
+
+    # Show how it's going in the deferred response, without editing it more often than Discord would like
+    last_update = 0.0
+    async def progress(status: str):
+        nonlocal last_update
+        if time.monotonic() - last_update >= BULK_PROGRESS_INTERVAL:
+            last_update = time.monotonic()
+            try:
+                await interaction.edit_original_response(content=status)
+            except discord.errors.HTTPException:
+                pass # Only a progress update, not worth stopping for
+
+    response = await logs.log_users(user_ids, reason, log_type, interaction.user, interaction.channel_id, progress)
+    # Progress updates are throttled, so the last one shown could be from partway through
+    await interaction_response_helper(interaction, response, edit_original=True)
+
+@client.tree.command(name="caches", description="Show lookup cache hit rates")
+@instrumented("command")
+async def caches_slash(interaction: discord.Interaction):
+    await interaction_response_helper(interaction, f"{get_all_stats()}\n{client.messages.get_stats()}")
+
 @client.tree.command(name="clear", description="Clear list of users waiting for reply")
+@instrumented("command")
 async def clear_slash(interaction: discord.Interaction):
     client.am.clear_entries()
     await interaction_response_helper(interaction, "Cleared waiting messages!")
 
 @client.tree.command(name="dm", description="Send a DM to a user")
 @discord.app_commands.describe(user="User", message="Message")
+@instrumented("command")
 async def dm_slash(interaction: discord.Interaction, user: discord.User, message: str):
     if interaction.channel_id is None: # Only for the linter's sake
         return
@@ -58,24 +136,30 @@ async def dm_slash(interaction: discord.Interaction, user: discord.User, message
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="dm-popup", description="Send a DM to a user, with a popup")
+@instrumented("command")
 async def popup_slash(interaction: discord.Interaction, user: discord.User):
     await interaction.response.send_modal(reply.DmModal(user))
 
 @client.tree.command(name="edit", description="Edit an incorrect log")
 @discord.app_commands.describe(user="User", message="New log entry", index="Log index to edit")
+@instrumented("command")
 async def edit_slash(interaction: discord.Interaction, user: discord.User, message: str, index: int):
-    response = logs.edit_log(user, index, message, interaction.user)
+    response = await logs.edit_log(user, index, message, interaction.user)
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="graph", description="Post graphs of moderator activity")
-async def graph_slash(interaction: discord.Interaction):
-    await post_plots(interaction.response)
+@discord.app_commands.describe(start="First day to include (YYYY-MM-DD)", end="Last day to include (YYYY-MM-DD)", staff="Only include logs by this staff member")
+@instrumented("command")
+async def graph_slash(interaction: discord.Interaction, start: str | None = None, end: str | None = None, staff: discord.User | None = None):
+    await post_plots(interaction, start, end, staff.name if staff else None)
 
 @client.tree.command(name="help", description="Post the help message")
+@instrumented("command")
 async def help_slash(interaction: discord.Interaction):
     await interaction.response.send_message(HELP_MESSAGE)
 
 @client.tree.command(name="id", description="Fetch the user ID of this DM thread")
+@instrumented("command")
 async def id_slash(interaction: discord.Interaction):
     if interaction.channel_id is None: # Only for linter's sake
         return
@@ -93,6 +177,7 @@ async def id_slash(interaction: discord.Interaction):
     discord.app_commands.Choice(name="Kick", value=LogTypes.KICK),
     discord.app_commands.Choice(name="Unban", value=LogTypes.UNBAN),
 ])
+@instrumented("command")
 async def log_slash(interaction: discord.Interaction, user: discord.User, reason: str, log_type: LogTypes):
     if interaction.channel_id is None:
         return
@@ -102,8 +187,14 @@ async def log_slash(interaction: discord.Interaction, user: discord.User, reason
     response = await logs.log_user(user, reason, log_type, interaction.user, interaction.channel_id)
     await interaction_response_helper(interaction, response)
 
+@client.tree.command(name="log-timings", description="Show how long each step of logging a user takes")
+@instrumented("command")
+async def log_timings_slash(interaction: discord.Interaction):
+    await interaction_response_helper(interaction, logs.get_log_timings())
+
 @client.tree.command(name="note", description="Add a user note")
 @discord.app_commands.describe(user="User", note="Note to add")
+@instrumented("command")
 async def note_slash(interaction: discord.Interaction, user: discord.User, note: str):
     if interaction.channel_id is None:
         return
@@ -113,37 +204,55 @@ async def note_slash(interaction: discord.Interaction, user: discord.User, note:
 
 @client.tree.command(name="open", description="Get user's reply thread")
 @discord.app_commands.describe(user="User")
+@instrumented("command")
 async def open_slash(interaction: discord.Interaction, user: discord.User):
     response = await reply.show_reply_thread(user)
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="preview", description="Prints out a DM message as the user will receive it")
 @discord.app_commands.describe(reason="Reason for logging", log_type="Log type")
+@instrumented("command")
 async def preview_slash(interaction: discord.Interaction, reason: str, log_type: LogTypes):
     response = logs.preview(reason, log_type)
     await interaction_response_helper(interaction, response)
 
+@client.tree.command(name="queues", description="Show how many outgoing posts are waiting to send")
+@instrumented("command")
+async def queues_slash(interaction: discord.Interaction):
+    await interaction_response_helper(interaction, scheduler.get_stats())
+
 @client.tree.command(name="remove", description="Remove a log")
 @discord.app_commands.describe(user="User", index="Log index to remove")
+@instrumented("command")
 async def remove_slash(interaction: discord.Interaction, user: discord.User, index: int):
     response = await logs.remove_error(user, index)
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="reply", description="Reply to a user from within their thread")
 @discord.app_commands.describe(message="Message")
+@instrumented("command")
 async def reply_slash(interaction: discord.Interaction, message: str):
     if interaction.channel_id is None: # Only for the linter's sake
         return
     response = await reply.reply(message, interaction.channel_id)
     await interaction_response_helper(interaction, response)
 
+@client.tree.command(name="response-times", description="Show how long users wait for a reply to their DMs")
+@discord.app_commands.describe(start="First day to include (YYYY-MM-DD)", end="Last day to include (YYYY-MM-DD)")
+@instrumented("command")
+async def response_times_slash(interaction: discord.Interaction, start: str | None = None, end: str | None = None):
+    response = client.response_times.report(start, end)
+    await interaction_response_helper(interaction, response)
+
 @client.tree.command(name="say", description="Say a message as the bot")
 @discord.app_commands.describe(channel="Channel to post in")
+@instrumented("command")
 async def say_slash(interaction: discord.Interaction, channel: discord.TextChannel | discord.Thread):
     await interaction.response.send_modal(SayModal(channel))
 
 @client.tree.command(name="scam", description="Log a scam")
 @discord.app_commands.describe(user="User")
+@instrumented("command")
 async def scam_slash(interaction: discord.Interaction, user: discord.User):
     if interaction.channel_id is None:
         return
@@ -153,37 +262,60 @@ async def scam_slash(interaction: discord.Interaction, user: discord.User):
 
 @client.tree.command(name="search", description="Search for a user's logs")
 @discord.app_commands.describe(user="User")
+@instrumented("command")
 async def search_slash(interaction: discord.Interaction, user: discord.User):
-    response = logs.search_logs(user)
+    response = await logs.search_logs(user)
     await interaction_response_helper(interaction, response)
 
+@client.tree.command(name="stats", description="Show how often each event handler and command runs, and how long it takes")
+@instrumented("command")
+async def stats_slash(interaction: discord.Interaction):
+    await interaction_response_helper(interaction, metrics.get_stats())
+
+@client.tree.command(name="sync", description="Re-register slash commands with Discord")
+@instrumented("command")
+async def sync_slash(interaction: discord.Interaction):
+    if interaction.guild is None:
+        await interaction.response.send_message("This can only be used in a server", ephemeral=True)
+        return
+    # Syncing can be held up by rate limits for longer than Discord will wait for a response
+    await interaction.response.defer()
+    await client.sync_guild(interaction.guild, force=True)
+    await interaction_response_helper(interaction, "Slash commands have been synced")
+
 @client.tree.command(name="unmute", description="Remove a user's timeout")
 @discord.app_commands.describe(user="User")
+@instrumented("command")
 async def unmute_slash(interaction: discord.Interaction, user: discord.Member):
     response = await client.spammers.unmute(user)
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="waiting", description="List users who are waiting for a reply")
+@instrumented("command")
 async def waiting_slash(interaction: discord.Interaction):
     response = client.am.list_waiting()
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="watch", description="Edit the watchlist")
 @discord.app_commands.describe(user="User", watch="Watch?")
+@instrumented("command")
 async def watch_slash(interaction: discord.Interaction, user: discord.User, watch: bool):
     response = client.watch.handle_watch(user, watch)
     await interaction_response_helper(interaction, response)
 
 @client.tree.command(name="watchlist", description="Print out the watchlist")
+@instrumented("command")
 async def watchlist_slash(interaction: discord.Interaction):
     response = client.watch.get_watchlist()
     await interaction_response_helper(interaction, response)
 
 ### Context commands ###
 @client.tree.context_menu(name="Report")
+@instrumented("command")
 async def report_context(interaction: discord.Interaction, message: discord.Message):
     await interaction.response.send_modal(ReportModal(message=message))
 
 @client.tree.context_menu(name="Report Message")
+@instrumented("command")
 async def report_message_context(interaction: discord.Interaction, _: discord.Member):
     await interaction.response.send_message("If you want to report someone, you need to select the message, not the user.", ephemeral=True)
@@ -35,12 +35,24 @@ class UserLogEntry:
         else:
             return [self.user_id, self.log_type, self.timestamp, self.log_message, self.staff, self.message_id]
 
+@dataclass
+class StartupState:
+    watchlist: list[int]
+    blocklist: list[tuple]
+    reply_threads: list[tuple[int, int]]    # (user id, thread id)
+    thread_states: list[tuple[int, int]]    # (thread id, state)
+    staffed_threads: list[int]              # Reply threads staff have been added to
+    waiting: list[tuple]                    # (user id, name, timestamp, message, url)
+    conversations: list[tuple]              # (user id, since)
+    outbox: list[tuple]                     # (id, user id, message, label, attempts, next attempt)
+    action_counts_since: str                # When actionCounts started counting, as an ISO timestamp
+
 """
 Initialize database
 
-Generates database with needed tables if it doesn't exist
+Generates database with needed tables if it doesn't exist, and loads everything we keep in memory while it has the DB open
 """
-def initialize():
+def initialize() -> StartupState:
     sqlconn = sqlite3.connect(DATABASE_PATH)
     sqlconn.execute("CREATE TABLE IF NOT EXISTS badeggs (dbid INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER, log INTEGER, date DATE, message TEXT, staff TEXT, post INTEGER);")
     sqlconn.execute("CREATE TABLE IF NOT EXISTS blocks (id TEXT);")
@@ -49,8 +61,33 @@ def initialize():
     sqlconn.execute("CREATE TABLE IF NOT EXISTS watching (id INT PRIMARY KEY);")
     sqlconn.execute("CREATE TABLE IF NOT EXISTS userReplyThreads (userid INT PRIMARY KEY, threadid INT);")
     sqlconn.execute("CREATE UNIQUE INDEX IF NOT EXISTS threadidIndex on userReplyThreads (threadid);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS replyThreadStates (threadid INT PRIMARY KEY, state INT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS staffedThreads (threadid INT PRIMARY KEY);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS waiting (userid INT PRIMARY KEY, name TEXT, timestamp TEXT, message TEXT, url TEXT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS conversations (userid INT PRIMARY KEY, since TEXT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS responseTimes (day TEXT PRIMARY KEY, sketch TEXT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS actionCounts (slot INT, log INT, count INT, PRIMARY KEY (slot, log));")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, userid INT, message TEXT, label TEXT, attempts INT, nextAttempt TEXT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS commandHashes (guildid INT PRIMARY KEY, hash TEXT);")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS eventCounts (channel INT, day TEXT, count INT, PRIMARY KEY (channel, day));")
+    sqlconn.execute("CREATE TABLE IF NOT EXISTS actionCountsSince (since TEXT);")
+    # Logs from before action counting started were never counted, so we need to know when that was to avoid uncounting them
+    sqlconn.execute("INSERT INTO actionCountsSince (since) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM actionCountsSince)", [datetime.now(timezone.utc).isoformat()])
     sqlconn.commit()
+
+    state = StartupState(
+        watchlist=[x[0] for x in sqlconn.execute("SELECT id FROM watching").fetchall()],
+        blocklist=sqlconn.execute("SELECT * FROM blocks").fetchall(),
+        reply_threads=sqlconn.execute("SELECT userid, threadid FROM userReplyThreads").fetchall(),
+        thread_states=sqlconn.execute("SELECT threadid, state FROM replyThreadStates").fetchall(),
+        staffed_threads=[x[0] for x in sqlconn.execute("SELECT threadid FROM staffedThreads").fetchall()],
+        waiting=sqlconn.execute("SELECT userid, name, timestamp, message, url FROM waiting").fetchall(),
+        conversations=sqlconn.execute("SELECT userid, since FROM conversations").fetchall(),
+        outbox=sqlconn.execute("SELECT id, userid, message, label, attempts, nextAttempt FROM outbox").fetchall(),
+        action_counts_since=sqlconn.execute("SELECT since FROM actionCountsSince").fetchone()[0],
+    )
     sqlconn.close()
+    return state
 
 def _db_read(query: tuple) -> list[tuple]:
     sqlconn = sqlite3.connect(DATABASE_PATH)
@@ -91,54 +128,65 @@ def search(user_id: int) -> list[UserLogEntry]:
     return entries
 
 
-def get_user_reply_thread_id(user_id: int) -> int | None:
+def get_log_columns(min_dbid: int) -> list[tuple]:
     """
-    Retrieves the user reply thread id associated with a user id from the db.
+    Retrieves the columns needed for stats from every log newer than the given dbid.
 
-    :param user_id: The user id to query.
-    :return: The thread id, or None if not present.
+    :param min_dbid: Only logs with a dbid greater than this are returned.
+    :return: A list of (dbid, log type, YYYY-MM-DD, staff) rows.
     """
-    query = ("SELECT threadid from userReplyThreads WHERE userid=?", [user_id])
-    search_results = _db_read(query)
-
-    if len(search_results) == 0:
-        return None
-
-    return search_results[0][0]
+    # Every date format we've stored starts with the day, so that's all we take
+    query = ("SELECT dbid, log, substr(date, 1, 10), staff FROM badeggs WHERE dbid > ?", [min_dbid])
+    return _db_read(query)
 
 
-def get_user_reply_thread_user_id(thread_id: int) -> int | None:
+def set_user_reply_thread(user_id: int, thread_id: int):
     """
-    Retrieves the user id associated with a user reply thread id from the db.
+    Stores the user reply thread id associated with a user id.
 
-    :param thread_id: The thread id to query.
-    :return: The user id, or None if not present.
+    :param user_id: The user id.
+    :param thread_id: The thread id.
     """
-    query = ("SELECT userid from userReplyThreads WHERE threadid=?", [thread_id])
-    search_results = _db_read(query)
+    query = ("REPLACE into userReplyThreads (userid, threadid) VALUES (?, ?)", [user_id, thread_id])
+    _db_write(query)
 
-    if len(search_results) == 0:
-        return None
 
-    return search_results[0][0]
+def set_thread_states(states: list[tuple[int, int]]):
+    """
+    Stores the state of several reply threads at once.
 
+    :param states: A list of (thread id, state) pairs.
+    """
+    sqlconn = sqlite3.connect(DATABASE_PATH)
+    sqlconn.executemany("REPLACE INTO replyThreadStates (threadid, state) VALUES (?, ?)", states)
+    sqlconn.commit()
+    sqlconn.close()
 
-def set_user_reply_thread(user_id: int, thread_id: int):
+
+def add_staffed_thread(thread_id: int):
     """
-    Stores the user reply thread id associated with a user id.
+    Records that staff have been added to a reply thread.
 
-    :param user_id: The user id.
     :param thread_id: The thread id.
     """
-    query = ("REPLACE into userReplyThreads (userid, threadid) VALUES (?, ?)", [user_id, thread_id])
+    query = ("INSERT OR IGNORE INTO staffedThreads (threadid) VALUES (?)", [thread_id])
     _db_write(query)
 
 
-def get_warn_count(userid: int) -> int:
-    query = ("SELECT COUNT(*) FROM badeggs WHERE id=? AND log = 1", [userid])
-    search_results = _db_read(query)
+def get_warn_counts(user_ids: list[int]) -> dict[int, int]:
+    """
+    Counts the warnings already given to several users.
 
-    return search_results[0][0] + 1
+    :param user_ids: The users to count for.
+    :return: A map of user id to their number of warnings. Users without any are left out.
+    """
+    placeholders = ", ".join(["?"] * len(user_ids))
+    query = (f"SELECT id, COUNT(*) FROM badeggs WHERE id IN ({placeholders}) AND log=? GROUP BY id", user_ids + [LogTypes.WARN])
+    return dict(_db_read(query))
+
+def get_post_log_count(post_id: int) -> int:
+    query = ("SELECT COUNT(*) FROM badeggs WHERE post=?", [post_id])
+    return _db_read(query)[0][0]
 
 def get_note_count(userid: int) -> int:
     query = ("SELECT COUNT(*) FROM badeggs WHERE id=? AND log = 2", [userid])
@@ -153,6 +201,25 @@ def add_log(log_entry: UserLogEntry):
         query = ("INSERT OR REPLACE INTO badeggs (dbid, id, log, date, message, staff, post) VALUES (?, ?, ?, ?, ?, ?, ?)", log_entry.as_list())
     _db_write(query)
 
+def add_logs(entries: list[UserLogEntry], staff: str, month: str, bans: int, warns: int):
+    """
+    Saves several new logs by the same staff member, and adds them onto the graph totals, all in one transaction.
+
+    :param entries: The new logs.
+    :param staff: The staff member who made them.
+    :param month: The month they were made in, as YYYY-MM.
+    :param bans: The number of bans to add to the totals.
+    :param warns: The number of warns to add to the totals.
+    """
+    sqlconn = sqlite3.connect(DATABASE_PATH)
+    # Used as a context manager, the connection commits everything at the end, or nothing if something fails
+    with sqlconn:
+        sqlconn.executemany("INSERT INTO badeggs (id, log, date, message, staff, post) VALUES (?, ?, ?, ?, ?, ?)", [x.as_list() for x in entries])
+        if bans > 0 or warns > 0:
+            sqlconn.execute("INSERT INTO staffLogs (staff, bans, warns) VALUES (?, ?, ?) ON CONFLICT (staff) DO UPDATE SET bans = bans + excluded.bans, warns = warns + excluded.warns", [staff, bans, warns])
+            sqlconn.execute("INSERT INTO monthLogs (month, bans, warns) VALUES (?, ?, ?) ON CONFLICT (month) DO UPDATE SET bans = bans + excluded.bans, warns = warns + excluded.warns", [month, bans, warns])
+    sqlconn.close()
+
 def remove_log(dbid: int):
     query = ("DELETE FROM badeggs WHERE dbid=?", [dbid])
     _db_write(query)
@@ -163,11 +230,6 @@ def clear_user_logs(userid: int):
         if log.dbid is not None:
             remove_log(log.dbid)
 
-def get_watch_list() -> list[int]:
-    query = ("SELECT * FROM watching",)
-    result = _db_read(query)
-    return [x[0] for x in result]
-
 def add_watch(userid: int):
     query = ("INSERT OR REPLACE INTO watching (id) VALUES (?)", [userid])
     _db_write(query)
@@ -206,10 +268,6 @@ def add_monthdata(month: str, bans: int, warns: int, is_replace: bool):
 
     _db_write(query)
 
-def get_blocklist() -> list[tuple]:
-    query = ("SELECT * FROM blocks",)
-    return _db_read(query)
-
 def add_block(userid: int):
     query = ("INSERT INTO blocks (id) VALUES (?)", [userid])
     _db_write(query)
@@ -217,3 +275,94 @@ def add_block(userid: int):
 def remove_block(userid: int):
     query = ("DELETE FROM blocks WHERE ID=?", [userid])
     _db_write(query)
+
+def set_waiting(userid: int, name: str, timestamp: str, message: str, url: str | None):
+    query = ("REPLACE INTO waiting (userid, name, timestamp, message, url) VALUES (?, ?, ?, ?, ?)", [userid, name, timestamp, message, url])
+    _db_write(query)
+
+def remove_waiting(userid: int):
+    query = ("DELETE FROM waiting WHERE userid=?", [userid])
+    _db_write(query)
+
+def clear_waiting():
+    query = ("DELETE FROM waiting",)
+    _db_write(query)
+
+def set_conversation(userid: int, since: str):
+    query = ("REPLACE INTO conversations (userid, since) VALUES (?, ?)", [userid, since])
+    _db_write(query)
+
+def remove_conversation(userid: int):
+    query = ("DELETE FROM conversations WHERE userid=?", [userid])
+    _db_write(query)
+
+def get_response_times(start_day: str, end_day: str) -> list[tuple]:
+    query = ("SELECT day, sketch FROM responseTimes WHERE day BETWEEN ? AND ?", [start_day, end_day])
+    return _db_read(query)
+
+def set_response_times(day: str, sketch: str):
+    query = ("REPLACE INTO responseTimes (day, sketch) VALUES (?, ?)", [day, sketch])
+    _db_write(query)
+
+def get_action_counts() -> list[tuple]:
+    query = ("SELECT slot, log, count FROM actionCounts",)
+    return _db_read(query)
+
+def add_action_counts(counts: list[tuple[int, int, int]]):
+    """
+    Adds onto the number of moderation actions in each hour of the week.
+
+    :param counts: A list of (hour of week, log type, count) rows.
+    """
+    sqlconn = sqlite3.connect(DATABASE_PATH)
+    sqlconn.executemany("INSERT INTO actionCounts (slot, log, count) VALUES (?, ?, ?) ON CONFLICT (slot, log) DO UPDATE SET count = count + excluded.count", counts)
+    sqlconn.commit()
+    sqlconn.close()
+
+def get_event_counts(start_day: str) -> list[tuple]:
+    query = ("SELECT channel, SUM(count) FROM eventCounts WHERE day >= ? GROUP BY channel", [start_day])
+    return _db_read(query)
+
+def add_event_counts(counts: list[tuple[int, str, int]]):
+    """
+    Adds onto the number of syslog events in each channel for each day.
+
+    :param counts: A list of (channel id, YYYY-MM-DD, count) rows.
+    """
+    sqlconn = sqlite3.connect(DATABASE_PATH)
+    sqlconn.executemany("INSERT INTO eventCounts (channel, day, count) VALUES (?, ?, ?) ON CONFLICT (channel, day) DO UPDATE SET count = count + excluded.count", counts)
+    sqlconn.commit()
+    sqlconn.close()
+
+def get_command_hash(guild_id: int) -> str | None:
+    query = ("SELECT hash FROM commandHashes WHERE guildid=?", [guild_id])
+    result = _db_read(query)
+    return result[0][0] if result else None
+
+def set_command_hash(guild_id: int, digest: str):
+    query = ("REPLACE INTO commandHashes (guildid, hash) VALUES (?, ?)", [guild_id, digest])
+    _db_write(query)
+
+def add_outbox(userid: int, message: str, label: str, next_attempt: str) -> int:
+    """
+    Saves a DM waiting to be delivered.
+
+    :param userid: The user to DM.
+    :param message: The text of the DM.
+    :param label: What the DM is.
+    :param next_attempt: When to try sending it, as an ISO timestamp.
+    :return: The id of the new entry.
+    """
+    sqlconn = sqlite3.connect(DATABASE_PATH)
+    cursor = sqlconn.execute("INSERT INTO outbox (userid, message, label, attempts, nextAttempt) VALUES (?, ?, ?, 0, ?)", [userid, message, label, next_attempt])
+    sqlconn.commit()
+    sqlconn.close()
+    return cursor.lastrowid
+
+def update_outbox(entry_id: int, attempts: int, next_attempt: str):
+    query = ("UPDATE outbox SET attempts=?, nextAttempt=? WHERE id=?", [attempts, next_attempt, entry_id])
+    _db_write(query)
+
+def remove_outbox(entry_id: int):
+    query = ("DELETE FROM outbox WHERE id=?", [entry_id])
+    _db_write(query)
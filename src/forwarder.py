@@ -1,18 +1,53 @@
-from collections import OrderedDict
-from threading import Lock
+import asyncio
+from enum import IntEnum
 from typing import cast
 
 import discord
 
 import db
 from client import client
-from config import HOME_SERVER, THREAD_ROLES
-from waiting import AnsweringMachineEntry, is_in_home_server
+from config import DM_BURST_WINDOW, THREAD_ROLES
+from scheduler import scheduler
+from waiting import AnsweringMachineEntry
 import utils
 
 # TODO: This is temporary until support for Forwarded messages comes in the next version of discord.py
 FORWARD_FLAG_VAL = 16384
 
+class DmBurst:
+    """
+    A group of DMs from a user, sent close enough together that they'll be forwarded as one post.
+    """
+    def __init__(self):
+        self.messages: list[tuple[discord.Message, bool]] = []
+        self.notes: list[str] = []
+
+    def add(self, message: discord.Message, edit: bool):
+        """
+        Adds a message to the burst.
+
+        :param message: The message that was sent.
+        :param edit: Whether this message was an edit.
+        """
+        self.messages.append((message, edit))
+
+    def add_note(self, note: str):
+        """
+        Adds a note for staff to go along with the messages.
+
+        :param note: The note.
+        """
+        self.notes.append(note)
+
+# How long, in seconds, to hold onto thread renames and staff additions before doing them
+# Discord heavily rate limits thread renames, so this lets several name changes be coalesced into one
+THREAD_MAINTENANCE_DELAY = 30
+
+class ThreadState(IntEnum):
+    ACTIVE = 0
+    ARCHIVED = 1
+    DELETED = 2
+
 class MessageForwarder:
     """
     Handles message forwarding between bouncer DMs and server staff.
@@ -29,14 +64,35 @@ class MessageForwarder:
         """
         Creates a new message forwarder.
         """
-        # Maps user ids to reply thread ids - used when receiving a DM to know which thread to forward it to
-        self._user_id_to_thread_id = LRUCache(lambda user_id: db.get_user_reply_thread_id(user_id), maxsize=50)
-
-        # Maps user reply thread ids to user ids - used when staff replies in a thread to know which user to send the reply to
-        self._thread_id_to_user_id = LRUCache(lambda thread_id: db.get_user_reply_thread_user_id(thread_id), maxsize=50)
-
-        # Both of the above use an LRU cache wrapper around accessing the DB so that every DM/reply does not trigger DB access
-        # The chosen cache size should be equal to the number of concurrent/active conversations we expect users to have with bouncer
+        # Maps user ids to reply thread ids and back
+        # User -> thread is used when receiving a DM to know which thread to forward it to
+        # Thread -> user is used when staff replies in a thread to know which user to send the reply to
+        # The whole table is kept in memory so that no DM/reply triggers DB access
+        state = cast(db.StartupState, client.startup_state)
+        self._reply_threads = ReplyThreadIndex(state.reply_threads)
+
+        # Maps user ids to an in progress thread lookup/creation, so that several DMs arriving at once share the one lookup
+        self._pending_threads: dict[int, asyncio.Task] = {}
+
+        # Tracks whether reply threads are archived or deleted, kept up to date by thread events
+        # discord.py only caches active threads, so without this we'd need to fetch a returning user's thread to find out which
+        # Thread objects for archived threads are held onto as well, so they can be un-archived without fetching them first
+        self._thread_states: dict[int, ThreadState] = {x[0]: ThreadState(x[1]) for x in state.thread_states}
+        # Threads that staff have already been added to, they stay members even if the thread is archived
+        self._staffed_threads: set[int] = set(state.staffed_threads)
+        # We're the last to need the startup state, so let it be freed
+        client.startup_state = None
+        self._archived_threads: dict[int, discord.Thread] = {}
+        self._scanned_archive = False
+
+        # Thread renames and staff additions that aren't needed right away are done in the background
+        # Only the most recent name for each thread is kept, so a burst of name changes costs a single rename
+        self._pending_renames: dict[int, tuple[discord.Thread, str]] = {}
+        self._pending_staff: dict[int, discord.Thread] = {}
+        self._maintenance_task: asyncio.Task | None = None
+
+        # Maps user ids to the DMs they've sent that are waiting to be forwarded together
+        self._dm_bursts: dict[int, DmBurst] = {}
 
     async def on_dm(self, message: discord.Message, edit: bool = False):
         """
@@ -52,12 +108,48 @@ class MessageForwarder:
         # Throw a warning about sending forwarded messages to the bot
         # TODO: This should be removed when discord.py updates
         if message.flags.value == FORWARD_FLAG_VAL:
-            await message.channel.send("Sorry, the bot cannot handle Forwarded messages. Perhaps try sending a link to the message?")
+            await scheduler.send(message.channel, "Sorry, the bot cannot handle Forwarded messages. Perhaps try sending a link to the message?")
+            return
+
+        # Users often send several short messages in a row, so gather them up and forward them as one post
+        # If this user already has messages waiting, this one just joins them
+        # The message joins before anything is awaited, so the burst stays in the order they were sent
+        burst = self._dm_bursts.get(message.author.id)
+        started = burst is None
+        if started:
+            burst = DmBurst()
+            self._dm_bursts[message.author.id] = burst
+        burst.add(message, edit)
+
+        try:
+            # Send the user a message so they know something actually happened
+            # This is done right away, even if the message is held back to be forwarded along with others
+            if not edit:
+                await message.add_reaction("📨")
+        except discord.errors.Forbidden as err:
+            if err.code == 50007:
+                burst.add_note("Unable to send message forward notification to the above user - Can't send messages to that user")
+            else:
+                burst.add_note(f"ERROR: While attempting to send message forward notification, there was an unexpected error: {err}")
+
+        if not started:
             return
+        await asyncio.sleep(DM_BURST_WINDOW)
+        del self._dm_bursts[message.author.id]
+        await self._forward_dm_burst(burst)
+
+    async def _forward_dm_burst(self, burst: DmBurst):
+        """
+        Forwards a group of DMs from a user to staff, as a single post.
+
+        :param burst: The messages to forward.
+        """
+        # Use the most recent message, so the user's details are up to date
+        message = burst.messages[-1][0]
 
         # If the user is in the home server, treat it as a regular DM
         # Otherwise, assume it's a ban appeal (users must have a mutual server to message bouncer, they should only be able to join those two)
-        is_ban_appeal = not is_in_home_server(message.author)
+        is_ban_appeal = await client.get_home_member(message.author.id) is None
 
         # If it's not a ban appeal they can be pinged b/c they're in the server where we're forwarding the message
         # Otherwise they can't, so we show username details instead
@@ -67,12 +159,17 @@ class MessageForwarder:
         if is_ban_appeal:
             reply_message += " (banned)"
 
-        if edit:
-            reply_message += " (edited)"
-
         # Fill in the rest of the message with what the user said
-        content = utils.combine_message(message)
-        reply_message += f": {content}"
+        contents = [utils.combine_message(x[0]) for x in burst.messages]
+        if len(burst.messages) == 1:
+            if burst.messages[0][1]:
+                reply_message += " (edited)"
+            reply_message += f": {contents[0]}"
+        else:
+            # Each message gets its own line, in the order they were sent
+            lines = [f"(edited) {content}" if edit else content for content, (_, edit) in zip(contents, burst.messages)]
+            reply_message += ":\n" + "\n".join(lines)
+        content = "\n".join(contents)
 
         # Get or create the appropriate thread for the message user
         reply_channel = await self.get_or_create_user_reply_thread(message.author, True, content=content)
@@ -80,20 +177,17 @@ class MessageForwarder:
         # Forward the message to the channel/thread
         log_mes = await utils.send_message(reply_message, reply_channel)
 
-        try:
-            # Send the user a message so they know something actually happened
-            if not edit:
-                await message.add_reaction("📨")
-        except discord.errors.Forbidden as err:
-            if err.code == 50007:
-                await reply_channel.send("Unable to send message forward notification to the above user - Can't send messages to that user")
-            else:
-                await reply_channel.send(f"ERROR: While attempting to send message forward notification, there was an unexpected error: {err}")
+        # The same problem is likely to come up for every message, so only mention each once
+        for note in dict.fromkeys(burst.notes):
+            await scheduler.send(reply_channel, note)
 
         # Record that the user is waiting for a reply
         url = log_mes.jump_url if log_mes else None
-        mes_entry = AnsweringMachineEntry(str(message.author), message.created_at, content, url)
+        # For edits, they've been waiting since the edit rather than the original message
+        mes_entry = AnsweringMachineEntry(str(message.author), message.edited_at or message.created_at, contents[-1], url)
         client.am.update_entry(message.author.id, mes_entry)
+        first = burst.messages[0][0]
+        client.response_times.start(message.author.id, first.edited_at or first.created_at)
 
     def get_userid_for_user_reply_thread(self, channel_id: int) -> int | None:
         """
@@ -102,7 +196,7 @@ class MessageForwarder:
         :param message: The staff reply message.
         :return: The user id, if message was sent in a user reply thread. None otherwise.
         """
-        return self._thread_id_to_user_id(channel_id)
+        return self._reply_threads.get_user_id(channel_id)
 
     def get_reply_thread_id_for_user(self, user: discord.User | discord.Member) -> int | None:
         """
@@ -111,7 +205,7 @@ class MessageForwarder:
         :param user: The user to get the reply thread id for.
         :return: The reply thread id, or None if the reply thread doesn't exist.
         """
-        return self._user_id_to_thread_id(user.id)
+        return self._reply_threads.get_thread_id(user.id)
 
     async def get_or_create_user_reply_thread(self, user: discord.User | discord.Member, from_user_message=False, content: str | None=None) -> discord.Thread:
         """
@@ -121,7 +215,25 @@ class MessageForwarder:
         :param from_user_message: Whether user reply thread retrieval is motivated by the user sending bouncer a message (True) or staff moderation (False).
         :return: The existing/new thread.
         """
-        thread_id = self._user_id_to_thread_id(user.id)
+        # If a lookup is already underway for this user, wait on that one rather than starting our own
+        # Otherwise a burst of DMs from a user without a cached thread would each fetch or create a thread
+        task = self._pending_threads.get(user.id)
+        if task is None:
+            task = asyncio.create_task(self._get_or_create_user_reply_thread(user, from_user_message, content))
+            self._pending_threads[user.id] = task
+            task.add_done_callback(lambda _: self._pending_threads.pop(user.id, None))
+        # Shielded so that one caller being cancelled doesn't cancel the lookup for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    async def _get_or_create_user_reply_thread(self, user: discord.User | discord.Member, from_user_message: bool, content: str | None) -> discord.Thread:
+        """
+        Does the work for get_or_create_user_reply_thread. Only one of these runs at a time for any given user.
+
+        :param user: The user to get or create the reply thread for.
+        :param from_user_message: Whether user reply thread retrieval is motivated by the user sending bouncer a message (True) or staff moderation (False).
+        :return: The existing/new thread.
+        """
+        thread_id = self._reply_threads.get_thread_id(user.id)
 
         if thread_id is None:
             # This is a first time user messaging bouncer or staff moderating a user -> create a reply thread for them
@@ -134,29 +246,105 @@ class MessageForwarder:
             await self._update_reply_thread(user, user_reply_thread)
             return user_reply_thread
 
-        # The thread is either archived or deleted; use fetch channel to find out which
-        # The order is important: fetch channel is an API call, so we want to avoid it if possible
-        try:
-            user_reply_thread = cast(discord.Thread, await client.fetch_channel(thread_id))
-
-            if from_user_message:
-                embed: discord.Embed = discord.Embed(
-                    title=f"\N{ENVELOPE} Mail from {user.global_name or user}",
-                    description=f"{content if len(content) <= 99 else content[:99] + '…'}" if content else None,
-                    colour=discord.Colour.blue(),
-                    url=user_reply_thread.jump_url)
-                await client.mailbox.send(embed=embed)
-            else:
-                # It was archived -> send a message to notify mods someone is starting a new conversation or that there was moderation activity
-                msg: str = f"New moderation activity for {user.mention}\nTheir reply thread has been un-archived: {user_reply_thread.mention}"
-                await client.mailbox.send(content=msg)
-            await self._update_reply_thread(user, user_reply_thread)
-            return user_reply_thread
-        except discord.errors.NotFound:
+        # The thread is either archived or deleted, check if we already know which
+        # Only if we don't do we use fetch channel to find out, as it's an API call
+        user_reply_thread = None
+        if self._thread_states.get(thread_id) != ThreadState.DELETED:
+            user_reply_thread = self._archived_threads.get(thread_id)
+            if user_reply_thread is None:
+                try:
+                    user_reply_thread = cast(discord.Thread, await client.fetch_channel(thread_id))
+                except discord.errors.NotFound:
+                    self._set_thread_state(thread_id, ThreadState.DELETED)
+
+        if user_reply_thread is not None:
+            try:
+                await self._update_reply_thread(user, user_reply_thread)
+            except discord.errors.NotFound:
+                # We missed it being deleted, such as while we were disconnected
+                self._archived_threads.pop(thread_id, None)
+                self._set_thread_state(thread_id, ThreadState.DELETED)
+                user_reply_thread = None
+
+        if user_reply_thread is None:
             # It was deleted
-            await client.mailbox.send(f"Reply thread for user {user.mention} was not found (it was probably deleted), creating a new one.")
+            await scheduler.send(client.mailbox, f"Reply thread for user {user.mention} was not found (it was probably deleted), creating a new one.")
             return await self._create_reply_thread(user, client.mailbox)
 
+        if from_user_message:
+            embed: discord.Embed = discord.Embed(
+                title=f"\N{ENVELOPE} Mail from {user.global_name or user}",
+                description=f"{content if len(content) <= 99 else content[:99] + '…'}" if content else None,
+                colour=discord.Colour.blue(),
+                url=user_reply_thread.jump_url)
+            await scheduler.send(client.mailbox, embed=embed)
+        else:
+            # It was archived -> send a message to notify mods someone is starting a new conversation or that there was moderation activity
+            msg: str = f"New moderation activity for {user.mention}\nTheir reply thread has been un-archived: {user_reply_thread.mention}"
+            await scheduler.send(client.mailbox, msg)
+        return user_reply_thread
+
+    def on_thread_update(self, thread_id: int, archived: bool, thread: discord.Thread | None):
+        """
+        Keeps track of reply threads being archived or un-archived.
+
+        :param thread_id: The id of the thread that was updated.
+        :param archived: Whether the thread is now archived.
+        :param thread: The updated thread, if discord.py has it.
+        """
+        if self._reply_threads.get_user_id(thread_id) is None:
+            return
+
+        if archived:
+            if thread is not None:
+                self._archived_threads[thread_id] = thread
+            self._set_thread_state(thread_id, ThreadState.ARCHIVED)
+        else:
+            self._archived_threads.pop(thread_id, None)
+            self._set_thread_state(thread_id, ThreadState.ACTIVE)
+
+    def on_thread_delete(self, thread_id: int):
+        """
+        Keeps track of reply threads being deleted.
+
+        :param thread_id: The id of the thread that was deleted.
+        """
+        if self._reply_threads.get_user_id(thread_id) is None:
+            return
+        self._archived_threads.pop(thread_id, None)
+        self._set_thread_state(thread_id, ThreadState.DELETED)
+
+    async def scan_archived_threads(self):
+        """
+        Looks through all of the mailbox's archived threads, so we have them on hand when a user messages us again.
+
+        Only runs the first time it's called, after that the thread events keep things up to date.
+        """
+        if self._scanned_archive:
+            return
+        # Set before scanning so a second call while this one runs doesn't scan again
+        self._scanned_archive = True
+
+        archived = []
+        try:
+            async for thread in client.mailbox.archived_threads(limit=None):
+                if self._reply_threads.get_user_id(thread.id) is not None:
+                    self._archived_threads[thread.id] = thread
+                    self._thread_states[thread.id] = ThreadState.ARCHIVED
+                    archived.append((thread.id, ThreadState.ARCHIVED))
+        except Exception:
+            # Let the next call try again, anything found so far is still worth saving
+            self._scanned_archive = False
+            raise
+        finally:
+            db.set_thread_states(archived)
+
+    def _set_thread_state(self, thread_id: int, state: ThreadState):
+        if self._thread_states.get(thread_id) == state:
+            return
+        self._thread_states[thread_id] = state
+        db.set_thread_states([(thread_id, state)])
+
     async def _create_reply_thread(self, user: discord.User | discord.Member, parent_channel: discord.TextChannel) -> discord.Thread:
         """
         Creates a reply thread for a user.
@@ -165,12 +353,10 @@ class MessageForwarder:
         :param parent_channel: The channel to create the thread in.
         :return: The new thread.
         """
-        thread = await parent_channel.create_thread(name=self._user_reply_thread_name(user), type=discord.ChannelType.public_thread)
+        thread = await parent_channel.create_thread(name=await self._user_reply_thread_name(user), type=discord.ChannelType.public_thread)
 
-        # Update DB and caches
-        db.set_user_reply_thread(user.id, thread.id)
-        self._user_id_to_thread_id.set(thread.id, user.id)
-        self._thread_id_to_user_id.set(user.id, thread.id)
+        # Update DB and index
+        self._reply_threads.set(user.id, thread.id)
 
         # Add staff to the thread
         await self._add_staff_to_thread(thread)
@@ -185,103 +371,142 @@ class MessageForwarder:
         """
         content = "This is a mention to add staff to this thread: "
 
-        message = await thread.send(content)
+        message = await scheduler.send(thread, content)
 
         content += ', '.join([f"<@&{role_id}>" for role_id in THREAD_ROLES])
 
         # By editing in a mention, we add staff to the thread without pinging them
         await message.edit(content=content)
+        self._staffed_threads.add(thread.id)
+        db.add_staffed_thread(thread.id)
 
     async def _update_reply_thread(self, user: discord.User | discord.Member, thread: discord.Thread):
         """
         Update a reply thread for a user. That means:
           - change the thread name to match the user's current name
           - un-archive it
+          - add staff to it when un-archiving, if they haven't been already
+
+        Only un-archiving is done right away, everything else is left to the background maintenance task.
 
         :param user: The user the thread is for.
         :param thread: The thread.
         """
-        thread_name = self._user_reply_thread_name(user)
+        thread_name = await self._user_reply_thread_name(user)
 
-        if thread.name != thread_name or thread.archived:
+        if thread.archived:
+            # We have to un-archive it now, and might as well rename it in the same call
+            self._pending_renames.pop(thread.id, None)
             await thread.edit(name=thread_name, archived=False)
-            await self._add_staff_to_thread(thread)
+            # Staff stay in a thread through archiving, so this is only needed once, for threads from before we kept track
+            if thread.id not in self._staffed_threads:
+                self._pending_staff[thread.id] = thread
+        elif thread.name != thread_name:
+            self._pending_renames[thread.id] = (thread, thread_name)
 
-    def _user_reply_thread_name(self, user: discord.User | discord.Member) -> str:
+        if (len(self._pending_renames) > 0 or len(self._pending_staff) > 0) and self._maintenance_task is None:
+            self._maintenance_task = asyncio.create_task(self._maintain_threads())
+
+    async def _maintain_threads(self):
+        """
+        Runs the queued up thread renames and staff additions, until there are none left.
+        """
+        while len(self._pending_renames) > 0 or len(self._pending_staff) > 0:
+            await asyncio.sleep(THREAD_MAINTENANCE_DELAY)
+            renames = self._pending_renames
+            staff = self._pending_staff
+            self._pending_renames = {}
+            self._pending_staff = {}
+
+            for thread, name in renames.values():
+                try:
+                    await thread.edit(name=name)
+                except discord.errors.HTTPException as err:
+                    print(f"Unable to rename reply thread {thread.id}: {err}")
+
+            for thread in staff.values():
+                if thread.id in self._staffed_threads:
+                    continue
+                try:
+                    await self._add_staff_to_thread(thread)
+                except discord.errors.HTTPException as err:
+                    print(f"Unable to add staff to reply thread {thread.id}: {err}")
+        self._maintenance_task = None
+
+    async def _user_reply_thread_name(self, user: discord.User | discord.Member) -> str:
         """
         Returns the name of a user reply thread for a user.
 
         :param user: The user to create the thread name for.
         :return: The thread name.
         """
-        # Try to get their SDV nickname (will be None if they're not in the SDV server, or not in the member cache) for a nicer thread name
-        home_guild = client.get_guild(HOME_SERVER)
-        if home_guild is not None:
-            member = home_guild.get_member(user.id)
-            if member is not None:
-                return f"{member.display_name} ({str(user)})"
+        # Try to get their SDV nickname (will be None if they're not in the SDV server) for a nicer thread name
+        member = await client.get_home_member(user.id)
+        if member is not None:
+            return f"{member.display_name} ({str(user)})"
 
         # If that didn't work, use their non-SDV name
         return str(user)
 
 
-class LRUCache:
+class ReplyThreadIndex:
     """
-    A custom LRU cache (https://en.wikipedia.org/wiki/Cache_replacement_policies#Least_recently_used_(LRU)).
-    Differs from stdlib's functools.lru_cache in that it allows bypassing func to set values directly.
+    An in-memory copy of the userReplyThreads table, indexed both ways.
 
-    Based on this comment: https://bugs.python.org/issue28178#msg276812.
+    The whole table is loaded at startup, so lookups never need to go to the DB, and writes go to both the DB and the index.
     """
-    def __init__(self, func, maxsize=128):
+    def __init__(self, rows: list[tuple[int, int]]):
         """
-        Creates a new instance.
+        Creates a new index, loaded with every reply thread in the DB.
 
-        :param func: The function to call to get the value for a key if not present in the cache.
-        :param maxsize: The maximum number of items to hold before evicting entries.
+        :param rows: Every (user id, thread id) pair in the DB.
         """
-        self._cache = OrderedDict()
-        self._lock = Lock()
-        self._func = func
-        self._maxsize = maxsize
+        self._user_to_thread: dict[int, int] = {}
+        self._thread_to_user: dict[int, int] = {}
+        for user_id, thread_id in rows:
+            self._user_to_thread[user_id] = thread_id
+            self._thread_to_user[thread_id] = user_id
 
-    def __call__(self, *args):
-        """
-        Retrieve the value for the given key (args).
+    def __len__(self) -> int:
+        return len(self._user_to_thread)
 
-        :param args: The key.
-        :return:
+    def get_thread_id(self, user_id: int) -> int | None:
         """
-        with self._lock:
-            # If in cache: set entry as recently used, and return it
-            if args in self._cache:
-                self._cache.move_to_end(args)
-                return self._cache[args]
-
-            # Not in cache: call function to get result, store in cache (this also sets the entry as recently used)
-            result = self._func(*args)
-            self._cache[args] = result
+        Get the reply thread id for a user.
 
-            # Evict the oldest entry if reached max cache size
-            if len(self._cache) > self._maxsize:
-                self._cache.popitem(last=False)
+        :param user_id: The user id.
+        :return: The thread id, or None if the user has no reply thread.
+        """
+        return self._user_to_thread.get(user_id)
 
-            return result
+    def get_user_id(self, thread_id: int) -> int | None:
+        """
+        Get the user id a reply thread belongs to.
 
-    def set(self, result, *args):
+        :param thread_id: The thread id.
+        :return: The user id, or None if this isn't a reply thread.
         """
-        Set the result for given args, bypassing func.
+        return self._thread_to_user.get(thread_id)
 
-        :param result: The result value.
-        :param args: The args that would be provided to func.
+    def set(self, user_id: int, thread_id: int):
         """
-        with self._lock:
-            self._cache[args] = result
-            self._cache.move_to_end(args)
-            if len(self._cache) > self._maxsize:
-                self._cache.popitem(last=False)
+        Sets the reply thread for a user, in both the DB and the index.
 
-    def debug_print(self):
-        print(self._cache)
+        :param user_id: The user id.
+        :param thread_id: The thread id.
+        """
+        db.set_user_reply_thread(user_id, thread_id)
+
+        # Drop the user's old thread, and whoever the thread used to belong to, same as the REPLACE does in the DB
+        old_thread_id = self._user_to_thread.pop(user_id, None)
+        if old_thread_id is not None:
+            self._thread_to_user.pop(old_thread_id, None)
+        old_user_id = self._thread_to_user.pop(thread_id, None)
+        if old_user_id is not None:
+            self._user_to_thread.pop(old_user_id, None)
+
+        self._user_to_thread[user_id] = thread_id
+        self._thread_to_user[thread_id] = user_id
 
 
 message_forwarder = MessageForwarder()
@@ -1,18 +1,50 @@
+import asyncio
+from dataclasses import dataclass
 from datetime import datetime, timezone
+import io
+import time
+from typing import Awaitable, Callable, TypeVar
 
 import discord
 
+from cache import AsyncCache
 import db
 import visualize
 from client import client
 from config import BAN_APPEAL_URL, DM_BAN, DM_WARN, INFO_CHANS, SERVER_NAME
 from logtypes import LogTypes, past_tense
 from reply import add_context_to_reply_thread
+from scheduler import Priority, scheduler
 import utils
 
+T = TypeVar("T")
+
 # Add extra message if more than threshold number of warns
 _WARN_THRESHOLD = 3
 
+# Most users that can be logged at once, and how many of them to look up or update at a time
+BULK_MAX_USERS = 100
+_BULK_CONCURRENCY = 5
+
+# Per-user log lookups, run off the event loop and cached until the user's logs change
+_USER_LOG_CACHE_SIZE = 256
+_USER_LOG_TTL = 60 * 60
+_user_logs = AsyncCache("user logs", lambda user_id: asyncio.to_thread(db.search, user_id), maxsize=_USER_LOG_CACHE_SIZE, ttl=_USER_LOG_TTL)
+
+@dataclass
+class _StepTiming:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+# How long each step of log_user takes, to see which one is holding up the response
+_step_timings: dict[str, _StepTiming] = {}
+
 BAN_KICK_MES = "Hi there! You've been {type} from the {name} Discord for violating the rules.\n> {mes}\nIf you have any questions, and for information on appeals, you can join <{url}>."
 SCAM_MES = "Hi there! You've been banned from the {name} Discord for posting scam links. If your account was compromised, please change your password, enable 2FA, and join <{url}> to appeal."
 WARN_MES = "Hi there! You've received warning #{count} in the {name} Discord for violating the rules.\n> {mes}\nPlease review {chans} for more info. If you have any questions, you can reply directly to this message to contact the staff."
@@ -22,8 +54,8 @@ Search logs
 
 Searches the database for the specified user
 """
-def search_logs(user: discord.User) -> str:
-    search_results = db.search(user.id)
+async def search_logs(user: discord.User) -> str:
+    search_results = await _user_logs.get(user.id)
     if len(search_results) == 0:
         return f"User {str(user)} was not found in the database\n"
     else:
@@ -44,6 +76,9 @@ Log User
 Notes an infraction for a user
 """
 async def log_user(user: discord.User, reason: str, state: LogTypes, author: discord.User | discord.Member, channel_id: int) -> str:
+    return await _timed("total", _log_user(user, reason, state, author, channel_id))
+
+async def _log_user(user: discord.User, reason: str, state: LogTypes, author: discord.User | discord.Member, channel_id: int) -> str:
     current_time = datetime.now(timezone.utc)
     output = ""
 
@@ -51,6 +86,7 @@ async def log_user(user: discord.User, reason: str, state: LogTypes, author: dis
         reason = "Banned for sending scam in chat."
 
     # Update records for graphing
+    client.activity_stats.add_action(state, current_time)
     match state:
         case LogTypes.BAN | LogTypes.SCAM:
             visualize.update_cache(author.name, (1, 0), utils.format_time(current_time))
@@ -59,6 +95,8 @@ async def log_user(user: discord.User, reason: str, state: LogTypes, author: dis
         case LogTypes.UNBAN:
             output = "Removing all old logs for unbanning"
             db.clear_user_logs(user.id)
+            _user_logs.invalidate(user.id)
+            visualize.invalidate_logs()
 
     # Generate message for log channel
     new_log = db.UserLogEntry(None, user.id, state, current_time, reason, author.name, None)
@@ -66,48 +104,161 @@ async def log_user(user: discord.User, reason: str, state: LogTypes, author: dis
     output += log_message
 
     # Send ban recommendation, if needed
-    count = db.get_warn_count(user.id)
+    count = len([x for x in await _user_logs.get(user.id) if x.log_type == LogTypes.WARN]) + 1
     if (state == LogTypes.WARN and count >= _WARN_THRESHOLD):
         output += f"\nThis user has received {_WARN_THRESHOLD} warnings or more. It is recommended that they be banned."
 
-    # Record this action in the user's reply thread
-    await add_context_to_reply_thread(channel_id, user, f"`{str(user)}` was {past_tense(state)}", reason)
+    # The DM is delivered in the background, whether it made it is posted in the reply thread
+    _queue_dm(user, state, reason, count)
+
+    # The reply thread post and log channel post don't depend on each other, so send them both at once
+    # Each step handles its own errors, so one failing doesn't stop the other, or the log being saved
+    async with asyncio.TaskGroup() as group:
+        context_task = group.create_task(_timed("reply thread", _post_context(channel_id, user, state, reason)))
+        # If we aren't noting, need to also write to log channel
+        if state != LogTypes.NOTE:
+            log_task = group.create_task(_timed("log channel", _post_log(log_message)))
 
+    output += context_task.result()
     log_mes_id = 0
-    # If we aren't noting, need to also write to log channel
     if state != LogTypes.NOTE:
-        # Post to channel, keep track of message ID
-        log_mes = await client.log.send(log_message)
-        log_mes_id = log_mes.id
-
-        try:
-            dm_chan = user.dm_channel
-            # If first time DMing, need to create channel
-            if not dm_chan:
-                dm_chan = await user.create_dm()
-
-            # Only send DM when specified in configs
-            if state == LogTypes.BAN and DM_BAN:
-                await dm_chan.send(BAN_KICK_MES.format(name=SERVER_NAME, type="banned", mes=reason, url=BAN_APPEAL_URL))
-            elif state == LogTypes.WARN and DM_WARN:
-                info = " and ".join([f"<#{x}>" for x in INFO_CHANS])
-                await dm_chan.send(WARN_MES.format(name=SERVER_NAME, count=count, mes=reason, chans=info))
-            elif state == LogTypes.KICK and DM_BAN:
-                await dm_chan.send(BAN_KICK_MES.format(name=SERVER_NAME, type="kicked", mes=reason, url=BAN_APPEAL_URL))
-            elif state == LogTypes.SCAM and DM_BAN:
-                await dm_chan.send(SCAM_MES.format(name=SERVER_NAME, url=BAN_APPEAL_URL))
-        # Exception handling
-        except discord.errors.HTTPException as err:
-            if err.code == 50007:
-                output += "\nCannot send messages to this user. It is likely that we do not share a server or that they are not accepting my DMs."
-            else:
-                output += f"\nERROR: While attempting to DM, there was an unexpected error: {err}"
+        log_mes_id, log_err = log_task.result()
+        output += log_err
 
     # Update database
     new_log.message_id = log_mes_id
     db.add_log(new_log)
+    _user_logs.invalidate(user.id)
+    return output
+
+"""
+Log Users
+
+Notes the same infraction for several users at once, such as during a raid
+"""
+async def log_users(user_ids: list[int], reason: str, state: LogTypes, author: discord.User | discord.Member, channel_id: int, progress: Callable[[str], Awaitable[None]]) -> str:
+    current_time = datetime.now(timezone.utc)
+    limit = asyncio.Semaphore(_BULK_CONCURRENCY)
+
+    if state == LogTypes.SCAM:
+        reason = "Banned for sending scam in chat."
+
+    # Look everyone up at once, rather than one at a time
+    async def fetch(user_id: int) -> discord.User | None:
+        async with limit:
+            try:
+                return client.get_user(user_id) or await client.fetch_user(user_id)
+            except discord.errors.NotFound:
+                return None
+    await progress(f"Looking up {len(user_ids)} users...")
+    fetched = await asyncio.gather(*[fetch(x) for x in user_ids])
+    users = [x for x in fetched if x is not None]
+    missing = [str(user_id) for user_id, user in zip(user_ids, fetched) if user is None]
+    if len(users) == 0:
+        return "I couldn't find any of those users"
+
+    # One post in the log channel for everyone, rather than one each
+    word = past_tense(state)
+    log_message = f"[{utils.format_time(current_time)}] {len(users)} users {word} by {author.name} - {reason}\n"
+    log_message += "\n".join([f"`{str(x)}` ({x.id})" for x in users])
+    try:
+        if len(log_message) <= utils.CHAR_LIMIT:
+            log_mes = await scheduler.send(client.log, log_message, Priority.HIGH)
+        else:
+            # Only one post ID is stored with the logs, so it has to stay a single post for /remove to clean it up
+            summary = f"[{utils.format_time(current_time)}] {len(users)} users {word} by {author.name}, the full log is attached"
+            log_file = discord.File(io.BytesIO(log_message.encode("utf-8")), filename="bulk_log.txt")
+            log_mes = await scheduler.send(client.log, summary, Priority.HIGH, file=log_file)
+    except discord.errors.HTTPException:
+        log_mes = None
+    log_mes_id = log_mes.id if log_mes is not None else 0
+
+    # All the logs and graph totals are written together, in a single transaction
+    warn_counts = db.get_warn_counts([x.id for x in users]) if state == LogTypes.WARN else {}
+    bans = len(users) if state in (LogTypes.BAN, LogTypes.SCAM) else 0
+    warns = len(users) if state == LogTypes.WARN else 0
+    entries = [db.UserLogEntry(None, x.id, state, current_time, reason, author.name, log_mes_id) for x in users]
+    db.add_logs(entries, author.name, utils.format_time(current_time)[:7], bans, warns)
+    visualize.stats_changed()
+
+    output = f"{word} {len(users)} users - {reason}"
+    if log_mes is None:
+        output += "\nERROR: Unable to post in the log channel"
+    if len(missing) > 0:
+        output += f"\nCouldn't find these users, so they weren't logged: {', '.join(missing)}"
+
+    for user in users:
+        _user_logs.invalidate(user.id)
+        client.activity_stats.add_action(state, current_time)
+        count = warn_counts.get(user.id, 0) + 1
+        if state == LogTypes.WARN and count >= _WARN_THRESHOLD:
+            output += f"\n`{str(user)}` has received {_WARN_THRESHOLD} warnings or more. It is recommended that they be banned."
+        # The DMs are delivered in the background, and their own limit on how many go out at once
+        _queue_dm(user, state, reason, count)
+
+    # Note it in everyone's reply thread, a few at a time so we don't flood Discord
+    done = 0
+    async def note(user: discord.User) -> str:
+        nonlocal done
+        async with limit:
+            err = await _post_context(channel_id, user, state, reason)
+        done += 1
+        await progress(f"Logged {len(users)} users, updated {done}/{len(users)} reply threads...")
+        return err
+    for err in await asyncio.gather(*[note(x) for x in users]):
+        output += err
+
     return output
 
+async def _post_context(channel_id: int, user: discord.User, state: LogTypes, reason: str) -> str:
+    # Record this action in the user's reply thread
+    try:
+        await add_context_to_reply_thread(channel_id, user, f"`{str(user)}` was {past_tense(state)}", reason)
+    except discord.errors.HTTPException as err:
+        return f"\nERROR: Unable to note this in the user's reply thread: {err}"
+    return ""
+
+async def _post_log(log_message: str) -> tuple[int, str]:
+    # Post to channel, keep track of message ID
+    try:
+        log_mes = await scheduler.send(client.log, log_message, Priority.HIGH)
+    except discord.errors.HTTPException as err:
+        return 0, f"\nERROR: Unable to post in the log channel: {err}"
+    return log_mes.id, ""
+
+def _queue_dm(user: discord.User, state: LogTypes, reason: str, count: int):
+    # Only send DM when specified in configs
+    if state == LogTypes.BAN and DM_BAN:
+        client.outbox.send(user.id, BAN_KICK_MES.format(name=SERVER_NAME, type="banned", mes=reason, url=BAN_APPEAL_URL), "ban notice")
+    elif state == LogTypes.WARN and DM_WARN:
+        info = " and ".join([f"<#{x}>" for x in INFO_CHANS])
+        client.outbox.send(user.id, WARN_MES.format(name=SERVER_NAME, count=count, mes=reason, chans=info), "warning")
+    elif state == LogTypes.KICK and DM_BAN:
+        client.outbox.send(user.id, BAN_KICK_MES.format(name=SERVER_NAME, type="kicked", mes=reason, url=BAN_APPEAL_URL), "kick notice")
+    elif state == LogTypes.SCAM and DM_BAN:
+        client.outbox.send(user.id, SCAM_MES.format(name=SERVER_NAME, url=BAN_APPEAL_URL), "scam ban notice")
+
+async def _timed(step: str, coro: Awaitable[T]) -> T:
+    start = time.monotonic()
+    try:
+        return await coro
+    finally:
+        _step_timings.setdefault(step, _StepTiming()).add(time.monotonic() - start)
+
+"""
+Log timings
+
+Lists how long each step of logging a user has taken
+"""
+def get_log_timings() -> str:
+    if len(_step_timings) == 0:
+        return "Nobody has been logged yet"
+    out = "Time taken by each step of logging a user\n"
+    for step, timing in _step_timings.items():
+        avg = timing.total / timing.count
+        out += f"`{step}`: {timing.count} times, {avg:.2f}s average, {timing.max:.2f}s max\n"
+    return out
+
 """
 Preview message
 
@@ -138,8 +289,8 @@ Edit log
 
 Edits the specified log index for the user
 """
-def edit_log(user: discord.User, index: int, message: str, author: discord.User | discord.Member) -> str:
-    search_results = db.search(user.id)
+async def edit_log(user: discord.User, index: int, message: str, author: discord.User | discord.Member) -> str:
+    search_results = await _user_logs.get(user.id)
     # If no results in database found, can't modify
     if not search_results:
         return "I couldn't find that user in the database"
@@ -149,10 +300,14 @@ def edit_log(user: discord.User, index: int, message: str, author: discord.User
         return f"I can't modify item number {index}, there aren't that many for this user"
 
     item = search_results[index - 1]
+    old_timestamp = item.timestamp
     item.timestamp = datetime.now(timezone.utc)
     item.log_message = message
     item.staff = str(author)
     db.add_log(item)
+    _user_logs.invalidate(user.id)
+    visualize.invalidate_logs()
+    client.activity_stats.move_action(item.log_type, old_timestamp, item.timestamp)
     return f"The log now reads as follows:\n{db.UserLogEntry.format(item)}"
 
 """
@@ -161,7 +316,7 @@ Remove Error
 Removes last database entry for specified user
 """
 async def remove_error(user: discord.User, index: int) -> str:
-    search_results = db.search(user.id)
+    search_results = await _user_logs.get(user.id)
     # If no results in database found, can't modify
     if not search_results:
         return "I couldn't find that user in the database"
@@ -173,7 +328,10 @@ async def remove_error(user: discord.User, index: int) -> str:
     item = search_results[index - 1]
     if item.dbid is not None: # This is for the linter's sake
         db.remove_log(item.dbid)
+        _user_logs.invalidate(user.id)
+        visualize.invalidate_logs()
     out = f"The following log was deleted:\n{db.UserLogEntry.format(item)}"
+    client.activity_stats.remove_action(item.log_type, item.timestamp)
 
     if item.log_type == LogTypes.BAN:
         visualize.update_cache(item.staff, (-1, 0), utils.format_time(item.timestamp))
@@ -181,8 +339,9 @@ async def remove_error(user: discord.User, index: int) -> str:
         visualize.update_cache(item.staff, (0, -1), utils.format_time(item.timestamp))
 
     # Search logging channel for matching post, and remove it
+    # Logs made in bulk share a post, which needs to stay as long as any of them are still around
     try:
-        if item.message_id != 0 and item.message_id is not None:
+        if item.message_id != 0 and item.message_id is not None and db.get_post_log_count(item.message_id) == 0:
             old_mes = await client.log.fetch_message(item.message_id)
             await old_mes.delete()
     # If we were unable to find message to delete, that's okay
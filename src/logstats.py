@@ -0,0 +1,85 @@
+from datetime import date
+
+import numpy as np
+
+import db
+from logtypes import LogTypes
+
+class LogStats:
+    """
+    Columns of the badeggs table held as NumPy arrays, so that stats over any date range or staff member can be computed without going back to the DB.
+
+    New logs are picked up by loading only the rows past the highest dbid we've seen.
+    Edits and removals change rows we've already loaded, so those throw everything out to be loaded again.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.max_dbid = 0
+        self.log_types = np.empty(0, dtype=np.int8)
+        self.days = np.empty(0, dtype="datetime64[D]")
+        self.staff = np.empty(0, dtype=np.int32)
+        # Staff are stored as indices into this list, rather than their names
+        self.staff_names: list[str] = []
+        self.staff_ids: dict[str, int] = {}
+
+    def refresh(self):
+        rows = db.get_log_columns(self.max_dbid)
+        if len(rows) == 0:
+            return
+        dbids, log_types, dates, staff = zip(*rows)
+
+        # Look up the index for each distinct name once, rather than for every row
+        names, inverse = np.unique(np.array(staff, dtype=str), return_inverse=True)
+        for name in names:
+            if name not in self.staff_ids:
+                self.staff_ids[str(name)] = len(self.staff_names)
+                self.staff_names.append(str(name))
+        staff_ids = np.array([self.staff_ids[x] for x in names], dtype=np.int32)
+
+        self.log_types = np.concatenate([self.log_types, np.array(log_types, dtype=np.int8)])
+        self.days = np.concatenate([self.days, np.array(dates, dtype="datetime64[D]")])
+        self.staff = np.concatenate([self.staff, staff_ids[inverse]])
+        self.max_dbid = max(dbids)
+
+    def summarize(self, start: date | None, end: date | None, staff: str | None) -> tuple[list[tuple], list[tuple], np.ndarray]:
+        """
+        Counts up logs within a date range, in the same shape as the staffLogs and monthLogs tables.
+
+        :param start: The first day to include, or None for no limit.
+        :param end: The last day to include, or None for no limit.
+        :param staff: The only staff member to include, or None for everyone.
+        :return: (staff, bans, warns) rows, (YYYY-MM, bans, warns) rows, and the number of logs of each LogTypes.
+        """
+        mask = np.ones(len(self.days), dtype=bool)
+        if start is not None:
+            mask &= self.days >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= self.days <= np.datetime64(end, "D")
+        if staff is not None:
+            mask &= self.staff == self.staff_ids.get(staff, -1)
+
+        log_types = self.log_types[mask]
+        staff_ids = self.staff[mask]
+        months = self.days[mask].astype("datetime64[M]").astype(np.int64)
+        type_counts = np.bincount(log_types, minlength=len(LogTypes))
+
+        # Scams are counted as bans, same as update_cache does
+        is_ban = (log_types == LogTypes.BAN) | (log_types == LogTypes.SCAM)
+        is_warn = log_types == LogTypes.WARN
+        if not (is_ban | is_warn).any():
+            return [], [], type_counts
+
+        staff_bans = np.bincount(staff_ids[is_ban], minlength=len(self.staff_names))
+        staff_warns = np.bincount(staff_ids[is_warn], minlength=len(self.staff_names))
+        staff_rows = [(self.staff_names[i], int(staff_bans[i]), int(staff_warns[i])) for i in np.flatnonzero(staff_bans + staff_warns)]
+
+        first = months[is_ban | is_warn].min()
+        span = months[is_ban | is_warn].max() - first + 1
+        month_bans = np.bincount(months[is_ban] - first, minlength=span)
+        month_warns = np.bincount(months[is_warn] - first, minlength=span)
+        labels = np.arange(first, first + span).astype("datetime64[M]").astype(str)
+        month_rows = [(str(labels[i]), int(month_bans[i]), int(month_warns[i])) for i in range(span)]
+
+        return staff_rows, month_rows, type_counts
@@ -3,32 +3,65 @@
 # 2018-2024
 
 from datetime import datetime, timezone
+import io
+import time
+
+_start_time = time.monotonic() # Taken before the imports below, so the time to ready includes loading them
 
 import discord
 import humanize
 
 import config
-from client import client
+from client import client, get_peak_rss
 from forwarder import message_forwarder
+from messagestore import StoredMessage
+from metrics import instrumented
+from scheduler import Priority, scheduler
+from tasks import spawn
 import utils
 
+_BULK_DELETE_MAX_AUTHORS = 5 # Number of authors to name in a bulk deletion entry before summarizing the rest
+
 """
 Delete message
 
 A helper function that deletes and logs the given message
 """
-async def delete_message_helper(message: discord.Message):
+async def delete_message_helper(message: StoredMessage):
     timedelta = datetime.now(timezone.utc) - message.created_at
-    mes = f":no_mobile_phones: **{str(message.author)}** deleted " \
-          f"in <#{message.channel.id}>: `{message.content}` \n" \
+    mes = f":no_mobile_phones: **{message.author_name}** deleted " \
+          f"in <#{message.channel_id}>: `{message.content}` \n" \
           f":timer: This message was visible for {humanize.precisedelta(timedelta)}."
     # Adds URLs for any attachments that were included in deleted message
     # These will likely become invalid, but it's nice to note them anyway
-    if message.attachments:
-        for item in message.attachments:
-            mes += '\n' + item.url
+    for url in message.attachments:
+        mes += '\n' + url
 
-    await client.syslog.add_log(mes)
+    await client.syslog.add_log(mes, message.channel_id)
+
+"""
+Bulk delete messages
+
+A helper function that logs a batch of deleted messages as a single entry, with the full transcript attached
+"""
+async def bulk_delete_helper(messages: list[StoredMessage]):
+    # Write the transcript straight into the buffer we upload, rather than building up one huge string
+    buffer = io.BytesIO()
+    transcript = io.TextIOWrapper(buffer, encoding="utf-8")
+    for message in messages:
+        transcript.write(f"[{message.created_at:%Y-%m-%d %H:%M:%S}] {message.author_name} ({message.author_id}): {message.content}\n")
+        for url in message.attachments:
+            transcript.write(f"    {url}\n")
+    transcript.flush()
+    transcript.detach()
+    buffer.seek(0)
+
+    authors = list(dict.fromkeys(message.author_name for message in messages))
+    author_str = ", ".join(authors[:_BULK_DELETE_MAX_AUTHORS])
+    if len(authors) > _BULK_DELETE_MAX_AUTHORS:
+        author_str += f" and {len(authors) - _BULK_DELETE_MAX_AUTHORS} others"
+    mes = f":wastebasket: {len(messages)} messages from **{author_str}** were bulk deleted in <#{messages[0].channel_id}>"
+    await client.syslog.add_file(mes, discord.File(buffer, filename="deleted_messages.txt"), messages[0].channel_id)
 
 """
 Should Log
@@ -46,6 +79,7 @@ On Ready
 Occurs when Discord bot is first brought online
 """
 @client.event
+@instrumented("event")
 async def on_ready():
     print('Logged in as')
     if client.user:
@@ -58,12 +92,25 @@ async def on_ready():
 
     await client.set_channels()
 
+    # on_ready fires again after reconnects, only the first one is how long startup took
+    global _start_time
+    if _start_time is not None:
+        print(f"Ready in {time.monotonic() - _start_time:.2f}s with member cache '{config.MEMBER_CACHE}' and chunking '{config.MEMBER_CHUNKING}', peak memory {get_peak_rss():.0f} MiB")
+        _start_time = None
+
+    if config.MEMBER_CHUNKING == "background":
+        spawn(client.chunk_home_server(), "chunk home server")
+
+    # Find out which reply threads are archived in the background, it can take a while with lots of threads
+    spawn(message_forwarder.scan_archived_threads(), "scan archived threads")
+
 """
 On Guild Available
 
 Runs when a guild (server) becomes available to the bot
 """
 @client.event
+@instrumented("event")
 async def on_guild_available(guild: discord.Guild):
     await client.sync_guild(guild)
 
@@ -73,16 +120,39 @@ On Thread Create
 Occurs when a new thread is created in the server
 """
 @client.event
+@instrumented("event")
 async def on_thread_create(thread: discord.Thread):
     await thread.join()
     await thread.edit(auto_archive_duration=10080) # Set all new threads to maximum timeout
 
+"""
+On Raw Thread Update
+
+Occurs when a thread is modified, such as being archived, whether or not it's in the thread cache
+"""
+@client.event
+@instrumented("event")
+async def on_raw_thread_update(payload: discord.RawThreadUpdateEvent):
+    archived = payload.data.get("thread_metadata", {}).get("archived", False)
+    message_forwarder.on_thread_update(payload.thread_id, archived, payload.thread)
+
+"""
+On Raw Thread Delete
+
+Occurs when a thread is deleted, whether or not it's in the thread cache
+"""
+@client.event
+@instrumented("event")
+async def on_raw_thread_delete(payload: discord.RawThreadDeleteEvent):
+    message_forwarder.on_thread_delete(payload.thread_id)
+
 """
 On Member Update
 
 Occurs when a user updates an attribute (nickname, roles, timeout)
 """
 @client.event
+@instrumented("event")
 async def on_member_update(before: discord.Member, after: discord.Member):
     if not should_log(before.guild):
         return
@@ -128,6 +198,7 @@ On Member Ban
 Occurs when a user is banned
 """
 @client.event
+@instrumented("event")
 async def on_member_ban(server: discord.Guild, member: discord.Member):
     if not should_log(server):
         return
@@ -140,57 +211,86 @@ async def on_member_ban(server: discord.Guild, member: discord.Member):
     await client.syslog.add_log(mes)
 
 """
-On Member Remove
+On Raw Member Remove
 
-Occurs when a user leaves the server
+Occurs when a user leaves the server, even if they weren't in the member cache
 """
 @client.event
-async def on_member_remove(member: discord.Member):
-    if not should_log(member.guild):
+@instrumented("event")
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    if payload.guild_id != config.HOME_SERVER:
         return
 
+    member = payload.user
+    client.forget_home_member(member.id)
     # We can remove left users from our answering machine
     client.am.remove_entry(member.id)
 
     if client.watch.should_note(member.id):
-        await utils.send_message(f"{str(member)} has left the server.", client.watchlist)
+        await utils.send_message(f"{str(member)} has left the server.", client.watchlist, Priority.LOW)
 
     mes = f":wave: **{str(member)} ({member.id})** has left"
     await client.syslog.add_log(mes)
 
 """
-On Message Delete
+Find stored message
 
-Occurs when a user's message is deleted
+Looks up a message's content from before it was edited or deleted, from our store or else discord.py's cache
+"""
+def find_stored_message(message_id: int, cached_message: discord.Message | None) -> StoredMessage | None:
+    message = client.messages.pop(message_id)
+    if message is None and cached_message is not None and not cached_message.author.bot:
+        message = StoredMessage.from_message(cached_message)
+    return message
+
+"""
+On Raw Message Delete
+
+Occurs when a message is deleted, whether or not discord.py still has it cached
 """
 @client.event
-async def on_message_delete(message: discord.Message):
-    if message.guild and not should_log(message.guild) or message.author.bot:
+@instrumented("event")
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    if payload.guild_id is not None and payload.guild_id != config.HOME_SERVER:
+        return
+
+    message = find_stored_message(payload.message_id, payload.cached_message)
+    # Either from a bot, or from before we started remembering
+    if message is None:
         return
 
     await delete_message_helper(message)
 
 """
-On Bulk Message Delete
+On Raw Bulk Message Delete
 
 Occurs when a user's messages are bulk deleted, such as ban or kick
 """
 @client.event
-async def on_bulk_message_delete(messages: list[discord.Message]):
-    if messages[0].guild and not should_log(messages[0].guild) or messages[0].author.bot:
+@instrumented("event")
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    if payload.guild_id is not None and payload.guild_id != config.HOME_SERVER:
         return
 
-    for message in messages:
-        await delete_message_helper(message)
+    cached = {x.id: x for x in payload.cached_messages}
+    # Sorting by ID puts them in the order they were posted
+    messages = [find_stored_message(x, cached.get(x)) for x in sorted(payload.message_ids)]
+    messages = [x for x in messages if x is not None]
+    if len(messages) == 0:
+        return
+
+    await bulk_delete_helper(messages)
 
 """
 On Message Edit
 
-Occurs when a user edits a message
+Occurs when a user edits a message discord.py still has cached, only used for DMs
 """
 @client.event
+@instrumented("event")
 async def on_message_edit(before: discord.Message, after: discord.Message):
-    if before.guild and not should_log(before.guild) or before.author.bot:
+    # Edits in the server are logged by on_raw_message_edit
+    if not isinstance(after.channel, discord.channel.DMChannel) or before.author.bot:
         return
 
     # Prevent embedding of content from triggering the log
@@ -198,18 +298,42 @@ async def on_message_edit(before: discord.Message, after: discord.Message):
         return
 
     # Forward an edit to a DM
-    if isinstance(after.channel, discord.channel.DMChannel):
-        await message_forwarder.on_dm(after, True)
+    await message_forwarder.on_dm(after, True)
+
+"""
+On Raw Message Edit
+
+Occurs when a message in the server is edited, whether or not discord.py still has it cached
+"""
+@client.event
+@instrumented("event")
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    if payload.guild_id != config.HOME_SERVER:
+        return
+
+    # Updates that don't change the content, such as embeds loading, don't include it
+    content = payload.data.get("content")
+    if content is None:
+        return
+
+    before = client.messages.get(payload.message_id)
+    if before is None:
+        before = find_stored_message(payload.message_id, payload.cached_message)
+        if before is None:
+            return
+    if before.content == content:
         return
+    old_content = before.content
+    client.messages.update(payload.message_id, content)
 
     try:
-        mes = f":pencil: **{str(before.author)}** modified in <#{before.channel.id}>: `{before.content}` to `{after.content}`"
-        await client.syslog.add_log(mes)
+        mes = f":pencil: **{before.author_name}** modified in <#{before.channel_id}>: `{old_content}` to `{content}`"
+        await client.syslog.add_log(mes, before.channel_id)
 
         # If user is on watchlist, then post it there as well
-        watching = client.watch.should_note(after.author.id)
+        watching = client.watch.should_note(before.author_id)
         if watching:
-            await utils.send_message(mes, client.watchlist)
+            await utils.send_message(mes, client.watchlist, Priority.LOW)
 
     except discord.errors.HTTPException as err:
         print(f"Unknown error with editing message. This message was unable to post for this reason: {err}\n")
@@ -220,12 +344,15 @@ On Member Join
 Occurs when a user joins the server
 """
 @client.event
+@instrumented("event")
 async def on_member_join(member: discord.Member):
     if not should_log(member.guild):
         return
 
+    client.forget_home_member(member.id)
+
     if client.watch.should_note(member.id):
-        await utils.send_message(f"{str(member)} has joined the server.", client.watchlist)
+        await utils.send_message(f"{str(member)} has joined the server.", client.watchlist, Priority.LOW)
 
     mes = f":confetti_ball: **{str(member)} ({member.id})** has joined"
     await client.syslog.add_log(mes)
@@ -236,16 +363,17 @@ On Voice State Update
 Occurs when a user joins/leaves an audio channel
 """
 @client.event
+@instrumented("event")
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
     if not should_log(member.guild) or member.bot:
         return
 
     if not after.channel:
         mes = f":mute: **{str(member)}** has left voice channel {before.channel.name}"
-        await client.syslog.add_log(mes)
+        await client.syslog.add_log(mes, before.channel.id)
     elif not before.channel:
         mes = f":loud_sound: **{str(member)}** has joined voice channel {after.channel.name}"
-        await client.syslog.add_log(mes)
+        await client.syslog.add_log(mes, after.channel.id)
 
 """
 On Reaction Remove
@@ -253,12 +381,13 @@ On Reaction Remove
 Occurs when a user removes a reaction from a message
 """
 @client.event
+@instrumented("event")
 async def on_reaction_remove(reaction: discord.Reaction, user: discord.Member):
     if user.bot:
         return
 
     emoji_name = reaction.emoji if isinstance(reaction.emoji, str) else reaction.emoji.name
-    await client.syslog.add_log(f":face_in_clouds: {str(user)} ({user.id}) removed the `{emoji_name}` emoji")
+    await client.syslog.add_log(f":face_in_clouds: {str(user)} ({user.id}) removed the `{emoji_name}` emoji", reaction.message.channel.id)
 
 """
 On Message
@@ -267,6 +396,7 @@ Occurs when a user posts a message
 More or less the main function
 """
 @client.event
+@instrumented("event")
 async def on_message(message: discord.Message):
     # Bouncer should not react to its own messages
     if message.author.id == client.user.id:
@@ -277,9 +407,13 @@ async def on_message(message: discord.Message):
         await message_forwarder.on_dm(message)
         return
 
+    # Remember it, so it can be logged if it's edited or deleted later
+    if should_log(message.guild) and not message.author.bot:
+        client.messages.add(message)
+
     (spammed, spam_message) = await client.spammers.check_spammer(message)
     if spammed:
-        await client.spam.send(spam_message)
+        await scheduler.send(client.spam, spam_message, Priority.HIGH)
         return
 
     # Check if user is on watchlist, and should be tracked
@@ -287,7 +421,7 @@ async def on_message(message: discord.Message):
     if watching:
         content = utils.combine_message(message)
         mes = f"<@{str(message.author.id)}> said in <#{message.channel.id}>: {content}"
-        await utils.send_message(mes, client.watchlist)
+        await utils.send_message(mes, client.watchlist, Priority.LOW)
 
     # If a user pings bouncer, log into mod channel
     if client.user in message.mentions:
@@ -296,6 +430,6 @@ async def on_message(message: discord.Message):
             description=f"{message.content if len(message.content) <= 99 else message.content[:99] + '…'}",
             colour=discord.Colour.blue(),
             url=message.jump_url)
-        await client.mailbox.send(embed=embed)
+        await scheduler.send(client.mailbox, embed=embed)
 
 client.run(config.DISCORD_KEY)
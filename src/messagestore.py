@@ -0,0 +1,83 @@
+import sys
+from datetime import datetime
+
+import discord
+
+class StoredMessage:
+    # Slots keep each record to a fixed handful of pointers, rather than a whole dict per message
+    __slots__ = ("message_id", "channel_id", "author_id", "author_name", "content", "attachments")
+
+    def __init__(self, message_id: int, channel_id: int, author_id: int, author_name: str, content: str, attachments: tuple[str, ...]):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.attachments = attachments
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "StoredMessage":
+        # The same few people post most of the messages, so share one copy of each name between them
+        return cls(message.id, message.channel.id, message.author.id, sys.intern(str(message.author)), message.content, tuple(x.url for x in message.attachments))
+
+    @property
+    def created_at(self) -> datetime:
+        # The time is part of the message ID, so there's no need to store it separately
+        return discord.utils.snowflake_time(self.message_id)
+
+class MessageStore:
+    """
+    Remembers the most recent messages posted in the server, so their content can still be logged when they're edited or deleted.
+
+    discord.py's own message cache only holds onto the last thousand or so, which on a busy server is a few minutes worth.
+    This keeps only what's needed for the logs, in a fixed size ring, so it can hold far more in the same memory and never grows past its size.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.slots: list[StoredMessage | None] = [None] * size
+        self.index: dict[int, int] = {} # Message ID -> slot
+        self.next = 0                   # Slot the next message goes in, overwriting the oldest
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def add(self, message: discord.Message):
+        old = self.slots[self.next]
+        if old is not None:
+            del self.index[old.message_id]
+        self.slots[self.next] = StoredMessage.from_message(message)
+        self.index[message.id] = self.next
+        self.next = (self.next + 1) % self.size
+
+    def get(self, message_id: int) -> StoredMessage | None:
+        slot = self.index.get(message_id)
+        return self.slots[slot] if slot is not None else None
+
+    def pop(self, message_id: int) -> StoredMessage | None:
+        slot = self.index.pop(message_id, None)
+        if slot is None:
+            return None
+        message = self.slots[slot]
+        self.slots[slot] = None
+        return message
+
+    def update(self, message_id: int, content: str):
+        message = self.get(message_id)
+        if message is not None:
+            message.content = content
+
+    def get_stats(self) -> str:
+        """
+        :return: A one line summary of how full the store is, and roughly how much memory each message takes.
+        """
+        if len(self) == 0:
+            return f"`message store`: 0/{self.size} messages"
+        records = [x for x in self.slots if x is not None]
+        total = sys.getsizeof(self.slots) + sys.getsizeof(self.index)
+        for record in records:
+            total += sys.getsizeof(record) + sys.getsizeof(record.content) + sys.getsizeof(record.attachments)
+            total += sum(sys.getsizeof(x) for x in record.attachments)
+            total += sys.getsizeof(record.message_id) + sys.getsizeof(record.channel_id) + sys.getsizeof(record.author_id)
+        # Names are shared, so only count each once
+        total += sum(sys.getsizeof(x) for x in {x.author_name for x in records})
+        return f"`message store`: {len(self)}/{self.size} messages, about {total // len(self)} bytes per message ({total / 1024 / 1024:.1f} MiB total)"
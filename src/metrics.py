@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable
+
+from config import METRICS_INTERVAL, METRICS_PATH
+from utils import replace_file
+
+SUB_BUCKET_BITS = 3                     # Each doubling of latency is split into 2^this buckets, so values are accurate to within 12.5%
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+EXPORT_BOUNDS = range(10, 27)           # Histogram buckets written for Prometheus, as powers of two microseconds (about 1ms to 67s)
+
+class LatencyHistogram:
+    """
+    Counts latencies in buckets that grow with the value, like HdrHistogram, so any percentile can be estimated in a fixed amount of memory.
+
+    Values are in microseconds. Below 2 * SUB_BUCKETS every value gets its own bucket. Above that, each power of two is split into SUB_BUCKETS equal parts.
+    """
+    def __init__(self):
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0  # Sum of every value, for the average
+        self.max = 0
+
+    def add(self, value: int):
+        value = max(value, 0)
+        if value < 2 * SUB_BUCKETS:
+            idx = value
+        else:
+            shift = value.bit_length() - 1 - SUB_BUCKET_BITS
+            idx = shift * SUB_BUCKETS + (value >> shift)
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: The quantile to estimate, between 0 and 1.
+        :return: The estimated value, in microseconds.
+        """
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen > rank:
+                lower, upper = self._bounds(idx)
+                return min((lower + upper) / 2, self.max)
+        return self.max
+
+    def cumulative(self, bound: int) -> int:
+        """
+        :param bound: An upper bound, in microseconds, which must be a power of two so it lines up with the buckets.
+        :return: How many values were below it.
+        """
+        return sum(count for idx, count in self.buckets.items() if self._bounds(idx)[1] <= bound)
+
+    def _bounds(self, idx: int) -> tuple[int, int]:
+        if idx < 2 * SUB_BUCKETS:
+            return idx, idx + 1
+        shift = idx // SUB_BUCKETS - 1
+        mantissa = idx - shift * SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+
+class HandlerMetrics:
+    def __init__(self):
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+class Metrics:
+    """
+    Counts calls, errors, and latency for each event handler and slash command they're added to with instrumented.
+
+    Shown by the /stats command, and written periodically as a Prometheus text file for a local scraper to pick up.
+    """
+    def __init__(self):
+        self.handlers: dict[tuple[str, str], HandlerMetrics] = {}  # (kind, name) -> metrics
+        self.write_task = None
+
+    def setup(self):
+        if self.write_task is None and METRICS_PATH is not None:
+            self.write_task = asyncio.create_task(self._write_loop())
+
+    def record(self, kind: str, name: str, elapsed: float, failed: bool):
+        handler = self.handlers.setdefault((kind, name), HandlerMetrics())
+        handler.latency.add(int(elapsed * 1_000_000))
+        if failed:
+            handler.errors += 1
+
+    def get_stats(self) -> str:
+        """
+        Lists the calls, errors, and latency percentiles of everything that's run so far, slowest first.
+
+        :return: The formatted stats.
+        """
+        if len(self.handlers) == 0:
+            return "Nothing has been run yet"
+        out = ""
+        for (kind, name), handler in sorted(self.handlers.items(), key=lambda x: x[1].latency.quantile(0.99), reverse=True):
+            latency = handler.latency
+            percentiles = ", ".join([f"p{int(q * 100)} {_format_us(latency.quantile(q))}" for q in (0.5, 0.9, 0.99)])
+            out += f"`{name}` ({kind}): {latency.count} calls, {handler.errors} errors, {percentiles}, max {_format_us(latency.max)}\n"
+        return out
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP bouncer_handler_calls_total Number of times each event handler or slash command has run.",
+            "# TYPE bouncer_handler_calls_total counter",
+        ]
+        for (kind, name), handler in self.handlers.items():
+            lines.append(f'bouncer_handler_calls_total{{kind="{kind}",name="{name}"}} {handler.latency.count}')
+        lines += [
+            "# HELP bouncer_handler_errors_total Number of times each event handler or slash command has raised an exception.",
+            "# TYPE bouncer_handler_errors_total counter",
+        ]
+        for (kind, name), handler in self.handlers.items():
+            lines.append(f'bouncer_handler_errors_total{{kind="{kind}",name="{name}"}} {handler.errors}')
+        lines += [
+            "# HELP bouncer_handler_latency_seconds How long each event handler or slash command takes to run.",
+            "# TYPE bouncer_handler_latency_seconds histogram",
+        ]
+        for (kind, name), handler in self.handlers.items():
+            labels = f'kind="{kind}",name="{name}"'
+            latency = handler.latency
+            for power in EXPORT_BOUNDS:
+                bound = 1 << power
+                lines.append(f'bouncer_handler_latency_seconds_bucket{{{labels},le="{bound / 1_000_000}"}} {latency.cumulative(bound)}')
+            lines.append(f'bouncer_handler_latency_seconds_bucket{{{labels},le="+Inf"}} {latency.count}')
+            lines.append(f"bouncer_handler_latency_seconds_sum{{{labels}}} {latency.total / 1_000_000}")
+            lines.append(f"bouncer_handler_latency_seconds_count{{{labels}}} {latency.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        replace_file(METRICS_PATH, self.to_prometheus())
+
+    async def _write_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            try:
+                self.write()
+            except OSError as err:
+                print(f"Unable to write metrics: {err}")
+
+def _format_us(value: float) -> str:
+    if value >= 1_000_000:
+        return f"{value / 1_000_000:.2f}s"
+    return f"{value / 1000:.1f}ms"
+
+metrics = Metrics()
+
+def instrumented(kind: str) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """
+    Records the calls, errors, and latency of an async function, under its name.
+
+    Goes underneath @client.event or a command's decorators, the wrapper keeps the name and signature they look at.
+
+    :param kind: What sort of function it is, such as "event" or "command".
+    """
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            failed = True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                metrics.record(kind, func.__name__, time.monotonic() - start, failed)
+        return wrapper
+    return decorator
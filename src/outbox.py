@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+import discord
+
+import db
+from scheduler import Priority, scheduler
+from tasks import spawn
+
+OUTBOX_CONCURRENCY = 3                      # Max number of DMs being delivered at once
+OUTBOX_MAX_ATTEMPTS = 5                     # Number of tries before giving up on a DM
+OUTBOX_RETRY_DELAY = timedelta(seconds=30)  # How long to wait before the first retry, doubled after each one
+
+SPAM_NOTICE = "spam notice"                 # Label of the DM sent to users muted for spamming
+
+@dataclass
+class OutboxEntry:
+    entry_id: int
+    user_id: int
+    message: str
+    label: str              # What the DM is, for reporting on it, such as "warning"
+    attempts: int
+    next_attempt: datetime
+
+class Outbox:
+    """
+    Delivers DMs to users in the background, so moderation commands don't have to wait on them, and retries them if Discord has trouble.
+
+    Every DM is saved to the DB before it's sent and only removed once it's been delivered or given up on, so none are lost if we restart.
+    How it went is posted in the user's reply thread.
+    """
+    def __init__(self, rows: list[tuple]):
+        self.entries: dict[int, OutboxEntry] = {}
+        # Min-heap of (next attempt, entry id), so the worker knows how long it can sleep for
+        self.queue: list[tuple[datetime, int]] = []
+        for row in rows:
+            entry = OutboxEntry(row[0], row[1], row[2], row[3], row[4], datetime.fromisoformat(row[5]))
+            self.entries[entry.entry_id] = entry
+            self.queue.append((entry.next_attempt, entry.entry_id))
+        heapq.heapify(self.queue)
+
+        self.client = None
+        self.wakeup = asyncio.Event()
+        self.limit = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self.worker_task = None
+
+    def setup(self, client: discord.Client):
+        self.client = client
+        if self.worker_task is None:
+            self.worker_task = asyncio.create_task(self._work())
+
+    def send(self, user_id: int, message: str, label: str):
+        """
+        Queues up a DM to be delivered.
+
+        :param user_id: The user to DM.
+        :param message: The text of the DM.
+        :param label: What the DM is, used when reporting whether it was delivered.
+        """
+        now = datetime.now(timezone.utc)
+        entry_id = db.add_outbox(user_id, message, label, now.isoformat())
+        self.entries[entry_id] = OutboxEntry(entry_id, user_id, message, label, 0, now)
+        heapq.heappush(self.queue, (now, entry_id))
+        self.wakeup.set()
+
+    async def _work(self):
+        while True:
+            # Cleared before looking at the queue, so anything sent while we're busy wakes us straight back up
+            self.wakeup.clear()
+            now = datetime.now(timezone.utc)
+            while len(self.queue) > 0 and self.queue[0][0] <= now:
+                _, entry_id = heapq.heappop(self.queue)
+                spawn(self._deliver(self.entries[entry_id]), "deliver DM")
+
+            timeout = (self.queue[0][0] - now).total_seconds() if len(self.queue) > 0 else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, entry: OutboxEntry):
+        async with self.limit:
+            user = None
+            try:
+                user = self.client.get_user(entry.user_id) or await self.client.fetch_user(entry.user_id)
+                dm_chan = user.dm_channel
+                # If first time DMing, need to create channel
+                if not dm_chan:
+                    dm_chan = await user.create_dm()
+                await scheduler.send(dm_chan, entry.message, Priority.HIGH)
+            except (discord.errors.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+                # Discord is having trouble, which should pass
+                await self._retry(entry, user, err)
+            except discord.errors.HTTPException as err:
+                # Anything else is going to fail the same way if we try again
+                if err.code == 50007:
+                    await self._finish(entry, user, "It is likely they have DMs closed or I am blocked.")
+                else:
+                    await self._finish(entry, user, f"There was an unexpected error: {err}")
+            else:
+                await self._finish(entry, user, None)
+
+    async def _retry(self, entry: OutboxEntry, user: discord.User | None, err: Exception):
+        entry.attempts += 1
+        if entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+            await self._finish(entry, user, f"Gave up after {entry.attempts} attempts, the last error was: {err}")
+            return
+        entry.next_attempt = datetime.now(timezone.utc) + OUTBOX_RETRY_DELAY * 2 ** (entry.attempts - 1)
+        db.update_outbox(entry.entry_id, entry.attempts, entry.next_attempt.isoformat())
+        heapq.heappush(self.queue, (entry.next_attempt, entry.entry_id))
+        self.wakeup.set()
+
+    async def _finish(self, entry: OutboxEntry, user: discord.User | None, error: str | None):
+        del self.entries[entry.entry_id]
+        db.remove_outbox(entry.entry_id)
+        if user is None:
+            print(f"Unable to DM user {entry.user_id} their {entry.label}: {error}")
+            return
+
+        # The forwarder needs the client, which creates us, so it can't be imported until now
+        from forwarder import message_forwarder
+        try:
+            # No need to start a thread just to say everything went fine
+            # Spam notices don't start one either, most spam accounts have DMs closed, and a raid would flood the mailbox with threads
+            if (error is None or entry.label == SPAM_NOTICE) and message_forwarder.get_reply_thread_id_for_user(user) is None:
+                if error is not None:
+                    print(f"Unable to DM {str(user)} their {entry.label}: {error}")
+                return
+            if error is None:
+                status = f":white_check_mark: The {entry.label} was delivered to `{str(user)}`"
+            else:
+                status = f":x: The {entry.label} couldn't be delivered to `{str(user)}`. {error}"
+            reply_thread = await message_forwarder.get_or_create_user_reply_thread(user)
+            await scheduler.send(reply_thread, status, Priority.NORMAL)
+        except discord.errors.HTTPException as err:
+            print(f"Unable to post DM status for {str(user)}: {err}")
@@ -0,0 +1,121 @@
+# Draws the plots, always in a worker process so matplotlib is never loaded by the bot itself
+import io
+import math
+
+import matplotlib
+matplotlib.use("Agg") # Plots are only ever rendered to images, never shown
+import matplotlib.pyplot as plt
+import numpy as np
+
+from logtypes import LogTypes
+
+days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+months = ["", "Jan", "Feb", "Mar", "Apr", "May", "June", "July", "Aug", "Sept", "Oct", "Nov", "Dec"]
+
+ACTIVITY_TOP_CHANNELS = 20 # Number of channels to show in the syslog activity plot
+
+def roundup(val: float) -> int:
+    return int(math.ceil(val / 10.0)) * 10 + 1
+
+def get_max(arr: list[tuple[int, int]]) -> int:
+    maximum = 0
+    for val in arr:
+        if (val[0] + val[1]) > maximum:
+            maximum = val[0] + val[1]
+    return roundup(maximum)
+
+# These are only given plain data and hand back PNG bytes, so they can be passed between processes
+def gen_user_plot(data: list[tuple]) -> bytes:
+    staff_data = {x[0]: [x[1], x[2]] for x in data}
+
+    staff_totals = {k: v[0]+v[1] for k, v in staff_data.items()}
+    sorted_totals = sorted(staff_totals, key=staff_totals.get)[::-1]
+
+    bans = [staff_data[x][0] for x in sorted_totals]
+    warns = [staff_data[x][1] for x in sorted_totals]
+    width = 0.5
+
+    fig = plt.figure(figsize=(20, 10))
+    ind = np.arange(len(staff_data.keys()))
+    plot1 = plt.bar(ind, bans, width, zorder=5)
+    plot2 = plt.bar(ind, warns, width, bottom=bans, zorder=5)
+    plt.ylabel("Logs")
+    plt.xlabel("User")
+    plt.title("Warns/Bans per User")
+    plt.xticks(ind, sorted_totals)
+    plt.xticks(rotation=-90)
+    plt.yticks(np.arange(0, get_max(list(staff_data.values())), 100))
+    plt.legend((plot1[0], plot2[0]), ("Bans", "Warns"))
+    plt.grid(True, axis="y")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+def gen_monthly_plot(data: list[tuple]) -> bytes:
+    fig = plt.figure(figsize=(10,6))
+    sorted_data = sorted(data)
+    month_data = {x[0]: [x[1], x[2]] for x in sorted_data}
+
+    bans = [month_data[x][0] for x in month_data]
+    warns = [month_data[x][1] for x in month_data]
+    labels = [f"{months[int(x.split('-')[1])]} {x.split('-')[0]}" for x in month_data.keys()]
+
+    width = 0.5
+
+    ind = np.arange(len(month_data.keys()))
+    plot1 = plt.bar(ind, bans, width, zorder=5)
+    plot2 = plt.bar(ind, warns, width, bottom=bans, zorder=5)
+    plt.ylabel("Logs")
+    plt.xlabel("Month")
+    plt.title("Warns/Bans per Month")
+    plt.xticks(ind[::6], labels[::6])
+    plt.xticks(rotation=-90)
+    plt.yticks(np.arange(0, get_max(list(month_data.values())), 50))
+    plt.legend((plot1[0], plot2[0]), ("Bans", "Warns"))
+    plt.tight_layout()
+    plt.grid(True, axis="y")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    plt.close(fig)
+    return buffer.getvalue()
+
+def gen_plots(staff_data: list[tuple], month_data: list[tuple]) -> tuple[bytes, bytes]:
+    return gen_user_plot(staff_data), gen_monthly_plot(month_data)
+
+def gen_heatmap(data: list[list[int]]) -> bytes:
+    fig, ax = plt.subplots(figsize=(20, 5))
+    image = ax.imshow(np.array(data), aspect="auto", cmap="viridis", interpolation="nearest")
+    ax.set_yticks(np.arange(len(LogTypes)), [x.name.title() for x in LogTypes])
+    ax.set_xticks(np.arange(0, 7 * 24, 24), days)
+    ax.set_xticks(np.arange(0, 7 * 24, 6), minor=True)
+    ax.set_xlabel("Hour of the week (UTC)")
+    ax.set_title("Moderation actions by hour of the week")
+    fig.colorbar(image, ax=ax, label="Logs")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+def gen_rates_plot(data: list[tuple[str, float]]) -> bytes:
+    # Busiest channel at the top
+    sorted_data = sorted(data, key=lambda x: x[1])[-ACTIVITY_TOP_CHANNELS:]
+
+    fig = plt.figure(figsize=(10, 8))
+    ind = np.arange(len(sorted_data))
+    plt.barh(ind, [x[1] for x in sorted_data], 0.5, zorder=5)
+    plt.yticks(ind, [x[0] for x in sorted_data])
+    plt.xlabel("Events per day")
+    plt.title("Syslog events per channel")
+    plt.grid(True, axis="x")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+def gen_activity_plots(heatmap: list[list[int]], rates: list[tuple[str, float]]) -> tuple[bytes, bytes]:
+    return gen_heatmap(heatmap), gen_rates_plot(rates)
@@ -3,6 +3,7 @@ import discord
 from client import client
 from config import SERVER_NAME
 from forwarder import message_forwarder
+from scheduler import Priority, scheduler
 from utils import CHAR_LIMIT, interaction_response_helper
 
 class DmModal(discord.ui.Modal):
@@ -52,23 +53,17 @@ DM
 Sends a private message to the specified user
 """
 async def dm(user: discord.User | discord.Member, message: str, channel_id: int) -> str:
-    try:
-        # If first DMing, need to create DM channel
-        dm_chan = user.dm_channel
-        if not dm_chan:
-            dm_chan = await client.create_dm(user)
-
-        await dm_chan.send(f"A message from the {SERVER_NAME} staff: {message}")
-        client.am.remove_entry(user.id)
+    # Delivered in the background, whether it made it is posted in the reply thread
+    client.outbox.send(user.id, f"A message from the {SERVER_NAME} staff: {message}", "staff message")
+    client.am.remove_entry(user.id)
+    client.response_times.stop(user.id)
 
+    try:
         # Add context in the user's reply thread
         await add_context_to_reply_thread(channel_id, user, f"Message sent to `{str(user)}`", message)
-        return f"Message sent to `{str(user)}`: {message}"
     except discord.errors.HTTPException as err:
-        if err.code == 50007:
-            return "Cannot send messages to this user. It is likely they have DM closed or I am blocked."
-        else:
-            return f"ERROR: While attempting to DM, there was an unexpected error: {err}"
+        return f"Message queued for `{str(user)}`, but it couldn't be noted in their reply thread: {err}"
+    return f"Message queued for `{str(user)}`: {message}"
 
 """
 Reply
@@ -98,7 +93,7 @@ async def add_context_to_reply_thread(channel_id: int, user: discord.User | disc
 
     reply_thread = await message_forwarder.get_or_create_user_reply_thread(user, content=message)
 
-    await reply_thread.send(f"{context}: {message}")
+    await scheduler.send(reply_thread, f"{context}: {message}", Priority.HIGH)
 
 """
 _get_user_for_reply
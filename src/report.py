@@ -5,6 +5,7 @@ import discord
 
 from client import client
 from forwarder import message_forwarder
+from scheduler import scheduler
 import utils
 
 class ReportResolveButton(discord.ui.Button):
@@ -111,7 +112,7 @@ class ReportModal(discord.ui.Modal):
             ] if field[1]
         ]
 
-        await client.mailbox.send(embed=embed, view=ReportMailboxView(reported_user=reported_user))
+        await scheduler.send(client.mailbox, embed=embed, view=ReportMailboxView(reported_user=reported_user))
         await interaction.response.send_message(
             content="Your report has been forwarded to the server staff. Thanks!",
             ephemeral=True)
@@ -0,0 +1,131 @@
+import json
+import math
+from datetime import datetime, timedelta, timezone
+
+import humanize
+
+import db
+from utils import format_time
+
+SKETCH_ACCURACY = 0.01          # Relative error of the reported percentiles
+MAX_WAIT = timedelta(days=7)    # Conversations left unanswered longer than this are assumed to have been dealt with some other way
+DEFAULT_RANGE = 30              # Number of days to report on when no range is given
+
+class QuantileSketch:
+    """
+    A mergeable sketch of a distribution, for estimating percentiles without keeping every value (see DDSketch).
+
+    Values are counted in buckets whose size grows exponentially, so every percentile is accurate to within SKETCH_ACCURACY of the true value.
+    Two sketches are merged by adding their bucket counts, so daily sketches can be combined into any range.
+    """
+    def __init__(self, zero: int = 0, bins: dict[int, int] | None = None):
+        self._gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        self._log_gamma = math.log(self._gamma)
+        self.zero = zero    # Count of values too small to bucket
+        self.bins = bins if bins is not None else {}
+
+    def __len__(self) -> int:
+        return self.zero + sum(self.bins.values())
+
+    def add(self, value: float):
+        if value < 1:
+            self.zero += 1
+            return
+        idx = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[idx] = self.bins.get(idx, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        self.zero += other.zero
+        for idx, count in other.bins.items():
+            self.bins[idx] = self.bins.get(idx, 0) + count
+
+    def quantile(self, q: float) -> float:
+        rank = q * (len(self) - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0
+        for idx in sorted(self.bins):
+            seen += self.bins[idx]
+            if rank < seen:
+                # Middle of the bucket, which is what keeps the relative error within bounds
+                return 2 * self._gamma ** idx / (self._gamma + 1)
+        return 0
+
+    def to_json(self) -> str:
+        return json.dumps({"zero": self.zero, "bins": self.bins})
+
+    @staticmethod
+    def from_json(data: str) -> "QuantileSketch":
+        parsed = json.loads(data)
+        return QuantileSketch(parsed["zero"], {int(k): v for k, v in parsed["bins"].items()})
+
+class ResponseTimes:
+    """
+    Measures how long users wait for staff to reply to their DMs.
+
+    A conversation starts with the first DM a user sends that hasn't been replied to, and ends when staff DM them.
+    The time between is added to a sketch for that day, which are saved to the DB, so any range can be reported on without keeping every measurement.
+    """
+    def __init__(self, rows: list[tuple]):
+        # Maps user ids to when they started waiting for a reply
+        self.waiting = {x[0]: datetime.fromisoformat(x[1]) for x in rows}
+
+    def start(self, user_id: int, timestamp: datetime):
+        """
+        Notes that a user has sent a DM. Does nothing if they're already waiting on a reply.
+
+        :param user_id: The user who sent the DM.
+        :param timestamp: When they sent it.
+        """
+        since = self.waiting.get(user_id)
+        if since is not None and timestamp - since < MAX_WAIT:
+            return
+        self.waiting[user_id] = timestamp
+        db.set_conversation(user_id, timestamp.isoformat())
+
+    def stop(self, user_id: int):
+        """
+        Notes that staff have replied to a user, recording how long they waited if they were waiting.
+
+        :param user_id: The user who was replied to.
+        """
+        since = self.waiting.pop(user_id, None)
+        if since is None:
+            return
+        db.remove_conversation(user_id)
+
+        now = datetime.now(timezone.utc)
+        if now - since > MAX_WAIT:
+            return
+        day = format_time(now)
+        stored = db.get_response_times(day, day)
+        sketch = QuantileSketch.from_json(stored[0][1]) if stored else QuantileSketch()
+        sketch.add((now - since).total_seconds())
+        db.set_response_times(day, sketch.to_json())
+
+    def report(self, start: str | None, end: str | None) -> str:
+        """
+        Summarizes response times over a range of days.
+
+        :param start: The first day to include, as YYYY-MM-DD. Defaults to DEFAULT_RANGE days ago.
+        :param end: The last day to include, as YYYY-MM-DD. Defaults to today.
+        :return: The formatted report.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            start_day = format_time(datetime.strptime(start, "%Y-%m-%d")) if start else format_time(now - timedelta(days=DEFAULT_RANGE))
+            end_day = format_time(datetime.strptime(end, "%Y-%m-%d")) if end else format_time(now)
+        except ValueError:
+            return "Dates need to be given as YYYY-MM-DD"
+
+        sketch = QuantileSketch()
+        for _, data in db.get_response_times(start_day, end_day):
+            sketch.merge(QuantileSketch.from_json(data))
+
+        if len(sketch) == 0:
+            return f"No DMs were replied to between {start_day} and {end_day}"
+
+        out = f"Time to first reply between {start_day} and {end_day}, over {len(sketch)} conversations\n"
+        for label, q in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+            out += f"{label}: {humanize.precisedelta(timedelta(seconds=sketch.quantile(q)), minimum_unit='minutes', format='%d')}\n"
+        return out
@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+
+import discord
+
+from tasks import spawn
+
+MAX_IN_FLIGHT = 5   # Max number of posts being sent at once, across all channels
+HIGH_RESERVED = 2   # Slots only high priority posts may use, so they can't be stuck behind others sleeping through rate limits
+MAX_LENGTH = 2000   # Discord's message length limit, coalesced posts need to stay under it
+
+class Priority(IntEnum):
+    HIGH = 0    # DMs to users and moderation actions
+    NORMAL = 1  # Forwarded DMs and mailbox notifications
+    LOW = 2     # Syslog and watchlist posts
+
+@dataclass
+class _Outgoing:
+    channel: discord.TextChannel | discord.Thread | discord.DMChannel
+    content: str | None
+    kwargs: dict
+    future: asyncio.Future
+    queued: float = field(default_factory=time.monotonic)
+
+class _ChannelQueue:
+    def __init__(self):
+        self.queues = {priority: deque() for priority in Priority}
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self.queues.values())
+
+    def pop(self) -> tuple[Priority, list[_Outgoing]]:
+        for priority in Priority:
+            queue = self.queues[priority]
+            if len(queue) == 0:
+                continue
+            batch = [queue.popleft()]
+            # Low priority posts that are next to each other can go out together, as long as they're plain text and fit
+            if priority == Priority.LOW and not batch[0].kwargs and batch[0].content is not None:
+                length = len(batch[0].content)
+                while len(queue) > 0 and not queue[0].kwargs and queue[0].content is not None and length + len(queue[0].content) + 1 <= MAX_LENGTH:
+                    length += len(queue[0].content) + 1
+                    batch.append(queue.popleft())
+            return priority, batch
+        raise IndexError("pop from empty channel queue")
+
+class MessageScheduler:
+    """
+    Sends all of bouncer's outgoing posts, so that a burst of logging can't hold up replies to users.
+
+    Each channel gets its own queue, drained in priority order by a task that only lives while there's something to send.
+    The number of posts in flight at once is capped, and when there are more waiting, the highest priority goes first.
+    A few of those slots are kept for high priority posts, since a slot is held while discord.py sleeps through a rate limit.
+    """
+    def __init__(self):
+        self._channels: dict[int, _ChannelQueue] = {}
+        self._in_flight = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+        # Metrics, per priority
+        self._sent = {priority: 0 for priority in Priority}
+        self._wait_total = {priority: 0.0 for priority in Priority}
+        self._wait_max = {priority: 0.0 for priority in Priority}
+
+    async def send(self, channel: discord.TextChannel | discord.Thread | discord.DMChannel, content: str | None = None, priority: Priority = Priority.NORMAL, **kwargs) -> discord.Message:
+        """
+        Queues up a post, and waits for it to be sent.
+
+        :param channel: The channel, thread, or DM to post in.
+        :param content: The text of the post.
+        :param priority: How urgently this needs to go out.
+        :param kwargs: Any other arguments for discord.abc.Messageable.send, such as embeds or files.
+        :return: The posted message. If it was coalesced with others, this is the combined message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        outgoing = _Outgoing(channel, content, kwargs, future)
+
+        key = channel.id
+        if key not in self._channels:
+            self._channels[key] = _ChannelQueue()
+            spawn(self._drain(key), "drain post queue")
+        self._channels[key].queues[priority].append(outgoing)
+
+        return await future
+
+    def get_stats(self) -> str:
+        """
+        Lists how many posts are waiting, and how long they've been waiting, for each priority.
+
+        :return: The formatted stats.
+        """
+        out = f"Outgoing posts ({self._in_flight} sending, {len(self._channels)} channels with queues)\n"
+        for priority in Priority:
+            depth = sum(len(x.queues[priority]) for x in self._channels.values())
+            sent = self._sent[priority]
+            avg = self._wait_total[priority] / sent if sent > 0 else 0
+            out += f"`{priority.name}`: {depth} queued, {sent} sent, {avg:.2f}s average wait, {self._wait_max[priority]:.2f}s max wait\n"
+        return out
+
+    async def _drain(self, key: int):
+        queue = self._channels[key]
+        while len(queue) > 0:
+            priority, batch = queue.pop()
+            await self._acquire(priority)
+            try:
+                await self._deliver(priority, batch)
+            finally:
+                self._release()
+        # Nothing else can be added between the check above and here, so the queue is safe to drop
+        del self._channels[key]
+
+    async def _deliver(self, priority: Priority, batch: list[_Outgoing]):
+        # Whoever queued these may have been cancelled while they waited, in which case they no longer want them sent
+        batch = [x for x in batch if not x.future.cancelled()]
+        if len(batch) == 0:
+            return
+
+        now = time.monotonic()
+        for item in batch:
+            wait = now - item.queued
+            self._sent[priority] += 1
+            self._wait_total[priority] += wait
+            self._wait_max[priority] = max(self._wait_max[priority], wait)
+
+        first = batch[0]
+        content = first.content if len(batch) == 1 else '\n'.join([x.content for x in batch])
+        try:
+            message = await first.channel.send(content, **first.kwargs)
+        except Exception as err:
+            # Hand the error back to whoever queued the post, as if they'd sent it themselves
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(err)
+        else:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_result(message)
+
+    async def _acquire(self, priority: Priority):
+        if self._in_flight < _slot_limit(priority):
+            self._in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        # When woken up, the slot has been handed to us directly by _release
+        await future
+
+    def _release(self):
+        self._in_flight -= 1
+        # Pass the slot to the most urgent waiter, rather than freeing it for whoever asks next
+        # Waiters are in priority order, and lower priorities have fewer slots, so if the first can't have it nobody can
+        while len(self._waiters) > 0 and self._in_flight < _slot_limit(self._waiters[0][0]):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+def _slot_limit(priority: Priority) -> int:
+    return MAX_IN_FLIGHT if priority == Priority.HIGH else MAX_IN_FLIGHT - HIGH_RESERVED
+
+scheduler = MessageScheduler()
@@ -4,6 +4,7 @@ from re import IGNORECASE, search
 import discord
 
 from config import IGNORE_SPAM, VALID_ROLES
+from outbox import SPAM_NOTICE, Outbox
 from utils import check_roles
 
 SPAM_MES_THRESHOLD = 5
@@ -36,8 +37,9 @@ class Spammer:
         return self.timestamp
 
 class Spammers:
-    def __init__(self):
+    def __init__(self, outbox: Outbox):
         self.spammers = {}
+        self.outbox = outbox
 
     async def check_spammer(self, message: discord.Message) -> tuple[bool, str]:
         if message.author.bot or message.content == "":
@@ -91,16 +93,7 @@ class Spammers:
         if uid in self.spammers:
             del self.spammers[uid]
 
-        # Create a DM channel between Bouncer if it doesn't exist
-        try:
-            dm_chan = user.dm_channel
-            if not dm_chan:
-                dm_chan = await user.create_dm()
-
-            await dm_chan.send(f"Hi there! This is an automated courtesy message informing you that your post(s) have been deleted either for spamming or attempting to ping everyone: '{txt}'. You have been temporarily muted from speaking in the server while the staff team reviews your message. If you have any questions, please reply to this bot.")
-        except discord.errors.HTTPException as err:
-            if err.code == 50007:
-                pass
+        self.outbox.send(uid, f"Hi there! This is an automated courtesy message informing you that your post(s) have been deleted either for spamming or attempting to ping everyone: '{txt}'. You have been temporarily muted from speaking in the server while the staff team reviews your message. If you have any questions, please reply to this bot.", SPAM_NOTICE)
         return f"<@{uid}> has been timed out for {timeout_len} minutes for spamming the message: `{txt}`"
 
     """
@@ -0,0 +1,24 @@
+import asyncio
+from typing import Any, Coroutine
+
+# asyncio only keeps a weak reference to running tasks, so anything started and not awaited needs holding onto here
+# Otherwise it can be garbage collected partway through
+_tasks: set[asyncio.Task] = set()
+
+def spawn(coro: Coroutine[Any, Any, Any], name: str) -> asyncio.Task:
+    """
+    Starts a task in the background, keeping it alive until it's done and printing any error it ends with.
+
+    :param coro: The coroutine to run.
+    :param name: What the task is, for the error message.
+    :return: The task.
+    """
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_finish)
+    return task
+
+def _finish(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task '{task.get_name()}' failed: {task.exception()!r}")
@@ -1,12 +1,30 @@
+from bisect import bisect_right
 from datetime import datetime
-from textwrap import wrap
+import os
+import re
 
 import discord
 
 from config import ADMIN_CATEGORIES
+from scheduler import Priority, scheduler
 
 CHAR_LIMIT = 1990 # The actual limit is 2000, but we'll be conservative
 
+def replace_file(path: str, content: str):
+    """
+    Replaces a file's contents, so that anyone reading it, or a crash partway through, only ever sees the old or new contents in full.
+
+    :param path: The file to replace.
+    :param content: The new contents.
+    """
+    # Written to a separate file first, then swapped in, which the OS does in one step
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as tmp:
+        tmp.write(content)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp_path, path)
+
 # Output is of the form YYYY-MM-DD
 def format_time(time: datetime) -> str:
     date = str(time).split()[0]
@@ -41,8 +59,13 @@ def combine_message(mes: discord.Message) -> str:
     return out
 
 # Interaction wrapper that prevents users from leaking info
-async def interaction_response_helper(interaction: discord.Interaction, response: str):
-    send_method = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
+# With edit_original, the first part replaces the deferred response, such as one that's been showing progress, rather than following it
+async def interaction_response_helper(interaction: discord.Interaction, response: str, edit_original: bool = False):
+    if edit_original:
+        async def send_method(content: str, ephemeral: bool = False):
+            await interaction.edit_original_response(content=content)
+    else:
+        send_method = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
     if interaction.channel.category.id in ADMIN_CATEGORIES:
         if len(response) > CHAR_LIMIT:
             messages = split_message(response)
@@ -54,25 +77,94 @@ async def interaction_response_helper(interaction: discord.Interaction, response
     else:
         await send_method("Don't leak info!", ephemeral=True)
 
+# Pieces of a message that shouldn't be split across two posts
+_ATOMIC_REGEX = re.compile(
+    r"```.*?```"                # Code blocks
+    r"|`[^`\n]+`"               # Inline code
+    r"|<(?:@[!&]?|#)\d+>"       # User, role, and channel mentions
+    r"|<a?:\w+:\d+>"            # Custom emoji
+    r"|<t:-?\d+(?::\w)?>",      # Timestamps
+    re.DOTALL)
+
+# Splits a message into pieces that fit under CHAR_LIMIT
+# Prefers to break on newlines, then on spaces, and never inside code or mentions unless they're too long to fit on their own
 def split_message(message: str) -> list[str]:
-    messages = message.split('\n')
-    to_send = [messages[0]]
-    for msg in messages[1:]:
-        if len(msg) >= CHAR_LIMIT:
-            to_send += wrap(msg, width=CHAR_LIMIT)
-        elif len(msg) + len(to_send[-1]) < CHAR_LIMIT:
-            to_send[-1] += f"\n{msg}"
-        else:
-            to_send.append(msg)
+    spans = [m.span() for m in _ATOMIC_REGEX.finditer(message)]
+    span_starts = [x[0] for x in spans]
+
+    # Each piece is a slice of the original message, so nothing is built up character by character
+    to_send = []
+    start = 0
+    while len(message) - start > CHAR_LIMIT:
+        end = start + CHAR_LIMIT
+        cut = _find_break(message, '\n', start, end, spans, span_starts)
+        if cut == -1:
+            cut = _find_break(message, ' ', start, end, spans, span_starts)
+        if cut != -1:
+            # The newline or space we're splitting on isn't needed in either piece
+            to_send.append(message[start:cut])
+            start = cut + 1
+            continue
+
+        # There's nowhere nice to break, so cut at the limit, or just before a piece that straddles it
+        idx = bisect_right(span_starts, end) - 1
+        if idx >= 0 and spans[idx][0] < end < spans[idx][1]:
+            if spans[idx][0] > start:
+                end = spans[idx][0]
+            else:
+                # That piece is too long to fit in a post by itself, so it'll have to be broken up
+                to_send += _split_token(message[spans[idx][0]:spans[idx][1]])
+                start = spans[idx][1]
+                continue
+        to_send.append(message[start:end])
+        start = end
+    if start < len(message) or len(to_send) == 0:
+        to_send.append(message[start:])
     return to_send
 
-async def send_message(message: str, channel: discord.TextChannel | discord.Thread) -> discord.Message | None:
+def _find_break(message: str, char: str, start: int, end: int, spans: list[tuple[int, int]], span_starts: list[int]) -> int:
+    # Finds the last instance of char we can split on without the piece going over the limit, skipping any inside a span
+    pos = message.rfind(char, start + 1, end + 1)
+    while pos != -1:
+        idx = bisect_right(span_starts, pos) - 1
+        if idx < 0 or pos >= spans[idx][1]:
+            return pos
+        pos = message.rfind(char, start + 1, spans[idx][0])
+    return -1
+
+def _split_token(token: str) -> list[str]:
+    if not (len(token) > 6 and token.startswith("```") and token.endswith("```")):
+        return [token[i:i + CHAR_LIMIT] for i in range(0, len(token), CHAR_LIMIT)]
+
+    # Code blocks are split by line, and the block is closed and reopened in each post so the formatting carries over
+    header, sep, body = token[3:-3].partition('\n')
+    if sep:
+        opener, closer = f"```{header}\n", "\n```"
+        body = body.removesuffix('\n')
+    else:
+        opener, closer = "```", "```"
+        body = header
+    width = CHAR_LIMIT - len(opener) - len(closer)
+    pieces = []
+    start = 0
+    while len(body) - start > width:
+        cut = body.rfind('\n', start, start + width + 1)
+        if cut > start:
+            pieces.append(body[start:cut])
+            start = cut + 1
+        else:
+            pieces.append(body[start:start + width])
+            start += width
+    pieces.append(body[start:])
+    return [f"{opener}{piece}{closer}" for piece in pieces]
+
+async def send_message(message: str, channel: discord.TextChannel | discord.Thread, priority: Priority = Priority.NORMAL) -> discord.Message | None:
     messages = split_message(message)
     first_id = None
     for msg in messages:
         if len(msg) > 0:
             try:
-                mid = await channel.send(msg)
+                mid = await scheduler.send(channel, msg, priority)
                 first_id = mid if first_id is None else first_id
             except discord.errors.DiscordServerError:
                 print("Discord server error, unable to post message")
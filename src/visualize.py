@@ -1,28 +1,32 @@
-# Calculates statistics and generates plots
-import math
+# Calculates statistics and posts plots of them
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import io
 
 import discord
-import matplotlib.pyplot as plt
-import numpy as np
 
 import db
-from config import MONTH_PLOT, USER_PLOT
+from logtypes import LogTypes
 
-months = ["", "Jan", "Feb", "Mar", "Apr", "May", "June", "July", "Aug", "Sept", "Oct", "Nov", "Dec"]
+# Rendering is slow, so it's done in a separate process to keep the bot responsive
+# The result is kept until the stats change, so repeated /graph calls don't need to render anything
+_executor: ProcessPoolExecutor | None = None
+_render_lock = asyncio.Lock()
+_stats_version = 0
+_plot_cache: tuple[int, bytes, bytes] | None = None
 
-def roundup(val: float) -> int:
-    return int(math.ceil(val / 10.0)) * 10 + 1
-
-def get_max(arr: list[tuple[int, int]]) -> int:
-    maximum = 0
-    for val in arr:
-        if (val[0] + val[1]) > maximum:
-            maximum = val[0] + val[1]
-    return roundup(maximum)
+# NumPy is only needed once someone asks for filtered stats, so nothing is loaded until then
+_log_stats = None
+# Set when existing logs change, so the loaded logs are thrown out before they're next used
+# The reset waits until then so it can't land while a refresh is running in another thread
+_logs_dirty = False
 
 # Val is a tuple which determines what to modify
 # (ban # change, warn # change)
 def update_cache(staff: str, val: tuple[int, int], date: str):
+    stats_changed()
+
     format_date = f"{date.split('-')[0]}-{date.split('-')[1]}"
 
     check_staff = db.get_staffdata(staff)
@@ -48,69 +52,79 @@ def update_cache(staff: str, val: tuple[int, int], date: str):
             print("Hey, a user is going to have a negative balance, that's no good.")
         db.add_monthdata(format_date, bans + val[0], warns + val[1], True)
 
-def gen_user_plot():
-    plt.clf()
-    data = db.get_staffdata(None)
-    staff_data = {x[0]: [x[1], x[2]] for x in data}
-
-    staff_totals = {k: v[0]+v[1] for k, v in staff_data.items()}
-    sorted_totals = sorted(staff_totals, key=staff_totals.get)[::-1]
-
-    bans = [staff_data[x][0] for x in sorted_totals]
-    warns = [staff_data[x][1] for x in sorted_totals]
-    width = 0.5
-
-    plt.subplots(figsize=(20, 10))
-    ind = np.arange(len(staff_data.keys()))
-    plot1 = plt.bar(ind, bans, width, zorder=5)
-    plot2 = plt.bar(ind, warns, width, bottom=bans, zorder=5)
-    plt.ylabel("Logs")
-    plt.xlabel("User")
-    plt.title("Warns/Bans per User")
-    plt.xticks(ind, sorted_totals)
-    plt.xticks(rotation=-90)
-    plt.yticks(np.arange(0, get_max(list(staff_data.values())), 100))
-    plt.legend((plot1[0], plot2[0]), ("Bans", "Warns"))
-    plt.grid(True, axis="y")
-
-    plt.savefig(USER_PLOT, bbox_inches='tight')
-
-def gen_monthly_plot():
-    plt.clf()
-    plt.figure(figsize=(10,6))
-    data = db.get_monthdata(None)
-    sorted_data = sorted(data)
-    month_data = {x[0]: [x[1], x[2]] for x in sorted_data}
-
-    bans = [month_data[x][0] for x in month_data]
-    warns = [month_data[x][1] for x in month_data]
-    labels = [f"{months[int(x.split('-')[1])]} {x.split('-')[0]}" for x in month_data.keys()]
-
-    width = 0.5
-
-    ind = np.arange(len(month_data.keys()))
-    plot1 = plt.bar(ind, bans, width, zorder=5)
-    plot2 = plt.bar(ind, warns, width, bottom=bans, zorder=5)
-    plt.ylabel("Logs")
-    plt.xlabel("Month")
-    plt.title("Warns/Bans per Month")
-    plt.xticks(ind[::6], labels[::6])
-    plt.xticks(rotation=-90)
-    plt.yticks(np.arange(0, get_max(list(month_data.values())), 50))
-    plt.legend((plot1[0], plot2[0]), ("Bans", "Warns"))
-    plt.tight_layout()
-    plt.grid(True, axis="y")
-
-    plt.savefig(MONTH_PLOT)
-
-async def post_plots(response: discord.InteractionResponse):
-    gen_user_plot()
-    gen_monthly_plot()
-
-    files = []
-    with open(USER_PLOT, 'rb') as user_file:
-        files.append(discord.File(user_file))
-
-    with open(MONTH_PLOT, 'rb') as month_file:
-        files.append(discord.File(month_file))
-    await response.send_message(files=files)
+# Called when the staff or monthly totals are changed directly, rather than through update_cache
+def stats_changed():
+    global _stats_version
+    _stats_version += 1
+
+# Called when existing logs are edited or removed, rather than new ones added
+def invalidate_logs():
+    global _logs_dirty
+    stats_changed()
+    _logs_dirty = True
+
+def _run(name: str, *args):
+    # Runs in the worker process, so the plotting libraries are only ever imported there
+    import plots
+    return getattr(plots, name)(*args)
+
+async def _render(name: str, *args) -> tuple[bytes, bytes]:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=1)
+    return await asyncio.get_running_loop().run_in_executor(_executor, _run, name, *args)
+
+async def post_plots(interaction: discord.Interaction, start: str | None = None, end: str | None = None, staff: str | None = None):
+    global _log_stats, _logs_dirty, _plot_cache
+    # Rendering can take a few seconds, longer than Discord will wait for a response
+    await interaction.response.defer()
+
+    content = None
+    # Only one render at a time, anyone else asking in the meantime will get the cached result once it's done
+    async with _render_lock:
+        if start is None and end is None and staff is None:
+            # All time stats come from the running totals, which also include logs cleared by unbans
+            if _plot_cache is None or _plot_cache[0] != _stats_version:
+                version = _stats_version
+                user_plot, month_plot = await _render("gen_plots", db.get_staffdata(None), db.get_monthdata(None))
+                _plot_cache = (version, user_plot, month_plot)
+            _, user_plot, month_plot = _plot_cache
+        else:
+            try:
+                start_day = datetime.strptime(start, "%Y-%m-%d").date() if start else None
+                end_day = datetime.strptime(end, "%Y-%m-%d").date() if end else None
+            except ValueError:
+                await interaction.followup.send("Dates need to be given as YYYY-MM-DD")
+                return
+
+            if _log_stats is None:
+                from logstats import LogStats
+                _log_stats = LogStats()
+            elif _logs_dirty:
+                _log_stats.reset()
+            _logs_dirty = False
+            # Loading the logs the first time can take a while, so keep it off the event loop too
+            await asyncio.to_thread(_log_stats.refresh)
+            staff_data, month_data, type_counts = _log_stats.summarize(start_day, end_day, staff)
+            if len(month_data) == 0:
+                await interaction.followup.send("There are no bans or warns in that range")
+                return
+
+            content = f"Logs from {start or 'the beginning'} to {end or 'now'}{f' by {staff}' if staff else ''}: "
+            content += ", ".join([f"{lt.name.title()}: {type_counts[lt]}" for lt in LogTypes])
+            user_plot, month_plot = await _render("gen_plots", staff_data, month_data)
+
+    files = [
+        discord.File(io.BytesIO(user_plot), filename="user_plot.png"),
+        discord.File(io.BytesIO(month_plot), filename="month_plot.png"),
+    ]
+    await interaction.followup.send(content=content, files=files)
+
+async def post_activity(interaction: discord.Interaction, heatmap: list[list[int]], rates: list[tuple[str, float]]):
+    await interaction.response.defer()
+    heatmap_plot, rates_plot = await _render("gen_activity_plots", heatmap, rates)
+    files = [
+        discord.File(io.BytesIO(heatmap_plot), filename="action_heatmap.png"),
+        discord.File(io.BytesIO(rates_plot), filename="channel_activity.png"),
+    ]
+    await interaction.followup.send(files=files)
@@ -1,11 +1,13 @@
+import asyncio
+import heapq
 from dataclasses import dataclass
-from datetime import datetime, timezone
-
-import discord
+from datetime import datetime, timedelta, timezone
 
+import db
 from utils import get_time_delta
-from config import HOME_SERVER
 
+EXPIRE_AFTER = timedelta(days=1)    # How long a user is listed as waiting before we drop them
+EXPIRE_INTERVAL = 5 * 60            # How often, in seconds, to check for users to drop
 
 @dataclass
 class AnsweringMachineEntry:
@@ -15,21 +17,44 @@ class AnsweringMachineEntry:
     message_url: str | None
 
 class AnsweringMachine:
-    def __init__(self):
-        self.waiting_list = {}
+    def __init__(self, rows: list[tuple]):
+        # Entries are kept in the order they were last updated, which is oldest message first
+        self.waiting_list: dict[int, AnsweringMachineEntry] = {}
+        # Min-heap of (timestamp, user id), so the oldest entries can be found without scanning everything
+        # Updated or removed entries are left in the heap, and skipped over when they no longer match the waiting list
+        self.expiry_heap: list[tuple[datetime, int]] = []
+        self.expiry_task = None
+
+        # Entries are saved to the DB, so nobody is forgotten about if we restart
+        entries = [(x[0], AnsweringMachineEntry(x[1], datetime.fromisoformat(x[2]), x[3], x[4])) for x in rows]
+        for user_id, entry in sorted(entries, key=lambda x: x[1].timestamp):
+            self.waiting_list[user_id] = entry
+            self.expiry_heap.append((entry.timestamp, user_id))
+        heapq.heapify(self.expiry_heap)
+
+    def setup(self):
+        if self.expiry_task is None:
+            self.expiry_task = asyncio.create_task(self._expire_loop())
 
     def remove_entry(self, user_id: int):
         if user_id in self.waiting_list:
             del self.waiting_list[user_id]
+            db.remove_waiting(user_id)
 
     def get_entries(self) -> dict[int, AnsweringMachineEntry]:
         return self.waiting_list
 
     def update_entry(self, user_id: int, user_entry: AnsweringMachineEntry):
+        # Remove it first, so the user moves to the back of the list
+        self.waiting_list.pop(user_id, None)
         self.waiting_list[user_id] = user_entry
+        heapq.heappush(self.expiry_heap, (user_entry.timestamp, user_id))
+        db.set_waiting(user_id, user_entry.name, user_entry.timestamp.isoformat(), user_entry.last_message, user_entry.message_url)
 
     def clear_entries(self):
         self.waiting_list.clear()
+        self.expiry_heap.clear()
+        db.clear_waiting()
 
     def list_waiting(self) -> str:
         waiting = self._gen_waiting_list()
@@ -37,20 +62,28 @@ class AnsweringMachine:
             return "There are no messages waiting!"
         return "\n".join(waiting)
 
+    def expire_entries(self):
+        # Drops everyone who has been waiting too long, only looking at as many entries as need to be dropped
+        cutoff = datetime.now(timezone.utc) - EXPIRE_AFTER
+        while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= cutoff:
+            timestamp, user_id = heapq.heappop(self.expiry_heap)
+            entry = self.waiting_list.get(user_id)
+            if entry is not None and entry.timestamp == timestamp:
+                self.remove_entry(user_id)
+
+    async def _expire_loop(self):
+        while True:
+            self.expire_entries()
+            await asyncio.sleep(EXPIRE_INTERVAL)
+
     def _gen_waiting_list(self) -> list[str]:
         curr_time = datetime.now(timezone.utc)
-        waiting_list = self.get_entries().copy()
         output_list = []
-        for key, item in waiting_list.items():
+        for key, item in self.get_entries().items():
             days, hours, minutes, _ = get_time_delta(curr_time, item.timestamp)
-            # Purge items that are older than one day
+            # Items older than one day will be dropped by the expiry task, no need to show them in the meantime
             if days > 0:
-                self.remove_entry(key)
-            else:
-                out = f"{item.name} ({key}) said `{item.last_message}` | {hours}h{minutes}m ago\n{item.message_url}\n"
-                output_list.append(out)
+                continue
+            out = f"{item.name} ({key}) said `{item.last_message}` | {hours}h{minutes}m ago\n{item.message_url}\n"
+            output_list.append(out)
         return output_list
-
-def is_in_home_server(author: discord.Member | discord.User) -> bool:
-    return HOME_SERVER in [x.id for x in author.mutual_guilds]
-
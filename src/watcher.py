@@ -3,8 +3,9 @@ import discord
 import db
 
 class Watcher:
-    def __init__(self):
-        self.watchlist = db.get_watch_list()
+    def __init__(self, watchlist: list[int]):
+        # Checked against every message posted, so keep it as a set
+        self.watchlist = set(watchlist)
 
     def should_note(self, uid: int) -> bool:
         return uid in self.watchlist
@@ -17,7 +18,7 @@ class Watcher:
     def handle_watch(self, user: discord.User, watch: bool) -> str:
         if watch:
             db.add_watch(user.id)
-            self.watchlist.append(user.id)
+            self.watchlist.add(user.id)
             return f"{str(user)} has been added to the watch list. :spy:"
         else:
             if user.id not in self.watchlist:
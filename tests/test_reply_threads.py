@@ -0,0 +1,96 @@
+# Checks that a burst of DMs from one user shares a single reply thread lookup
+import asyncio
+import importlib
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BURST_SIZE = 50
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeThread:
+    def __init__(self, thread_id: int, archived: bool):
+        self.id = thread_id
+        self.archived = archived
+        self.name = "user"
+        self.mention = f"<#{thread_id}>"
+        self.jump_url = f"https://discord.com/channels/0/{thread_id}"
+
+    async def edit(self, **kwargs):
+        # Give the other DMs a chance to pile up while Discord "responds"
+        await asyncio.sleep(0.01)
+        self.archived = kwargs.get("archived", self.archived)
+
+class FakeMailbox:
+    def __init__(self):
+        self.id = 1
+        self.created = 0
+
+    async def create_thread(self, **kwargs) -> FakeThread:
+        self.created += 1
+        await asyncio.sleep(0.01)
+        return FakeThread(1000 + self.created, False)
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.global_name = None
+
+    def __str__(self) -> str:
+        return "user"
+
+@pytest.fixture
+def forwarder(tmp_path, monkeypatch):
+    # The bot reads its config and DB from ./private, so give it a scratch copy to work in
+    os.makedirs(tmp_path / "private")
+    shutil.copy(os.path.join(ROOT, "config.example.yaml"), tmp_path / "private" / "config.yaml")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(os.path.join(ROOT, "src"))
+    for name in list(sys.modules):
+        if name in ("config", "db", "client", "forwarder"):
+            del sys.modules[name]
+    module = importlib.import_module("forwarder")
+
+    sent = []
+    async def send(channel, content=None, priority=None, **kwargs):
+        sent.append(channel)
+        return FakeMessage()
+    async def get_home_member(user_id):
+        return None
+    monkeypatch.setattr(module, "scheduler", SimpleNamespace(send=send))
+    monkeypatch.setattr(module.client, "get_home_member", get_home_member)
+    monkeypatch.setattr(module.client, "mailbox", FakeMailbox(), raising=False)
+    return module
+
+async def _burst(forwarder, user: FakeUser) -> set[int]:
+    threads = await asyncio.gather(*[forwarder.message_forwarder.get_or_create_user_reply_thread(user, True, "hi") for _ in range(BURST_SIZE)])
+    return {x.id for x in threads}
+
+def test_burst_creates_one_thread(forwarder):
+    threads = asyncio.run(_burst(forwarder, FakeUser(1)))
+    assert len(threads) == 1
+    assert forwarder.client.mailbox.created == 1
+
+def test_burst_fetches_archived_thread_once(forwarder, monkeypatch):
+    fetches = 0
+    async def fetch_channel(channel_id):
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.01)
+        return FakeThread(channel_id, True)
+    monkeypatch.setattr(forwarder.client, "get_channel", lambda channel_id: None)
+    monkeypatch.setattr(forwarder.client, "fetch_channel", fetch_channel)
+    forwarder.message_forwarder._reply_threads.set(2, 500)
+
+    threads = asyncio.run(_burst(forwarder, FakeUser(2)))
+    assert threads == {500}
+    assert fetches == 1
+    assert forwarder.client.mailbox.created == 0